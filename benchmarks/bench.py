@@ -0,0 +1,327 @@
+"""Benchmarks for milatools' transport paths, run against fake executables.
+
+No cluster is needed: the fake ssh, salloc, squeue and code from shims.py are
+put first on PATH and HOME points to a temporary directory. Results can be
+saved with --output and compared to a previous run (e.g. on another commit)
+with --compare:
+
+    python benchmarks/bench.py --output before.json
+    git checkout my-branch
+    python benchmarks/bench.py --compare before.json
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+here = os.path.dirname(os.path.abspath(__file__))
+root = os.path.dirname(here)
+
+benchmarks = {}
+
+
+def benchmark(fn):
+    """Register fn, which runs one sample and returns its duration in seconds.
+
+    fn may also return (duration, {metric: value}) to report extra metrics.
+    """
+    benchmarks[fn.__name__] = fn
+    return fn
+
+
+def timed(fn, *args, **kwargs):
+    t0 = time.perf_counter()
+    fn(*args, **kwargs)
+    return time.perf_counter() - t0
+
+
+@benchmark
+def master_startup():
+    from milatools.utils import SSHConnection, sockdir
+
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(os.path.join(sockdir, "milatools.bench-fresh"))
+    t0 = time.perf_counter()
+    conn = SSHConnection("bench-fresh")
+    conn.wait()
+    return time.perf_counter() - t0
+
+
+@benchmark
+def master_reuse():
+    from milatools.utils import SSHConnection
+
+    connection().wait()
+    return timed(SSHConnection, "bench")
+
+
+@benchmark
+def get():
+    return timed(connection().get, "true")
+
+
+@benchmark
+def get_x10():
+    conn = connection()
+    return timed(lambda: [conn.get("true") for _ in range(10)])
+
+
+@benchmark
+def get_many_x10():
+    return timed(connection().get_many, ["true"] * 10)
+
+
+@benchmark
+def shell_get():
+    return timed(connection(shell=True).get, "true")
+
+
+@benchmark
+def extract_stream():
+    nlines = 100_000
+    duration = timed(connection().extract, f"seq {nlines}; echo done", pattern="(done)")
+    return duration, {"lines_per_s": nlines / duration}
+
+
+@benchmark
+def find_allocation():
+    from milatools.commands import _find_allocation
+
+    def run():
+        proc, _ = _find_allocation(connection())
+        proc.wait()
+
+    return timed(run)
+
+
+@benchmark
+def code_cold():
+    shutil.rmtree(os.path.join(os.environ["XDG_CACHE_HOME"]), ignore_errors=True)
+    return timed(run_mila, "code", "project")
+
+
+@benchmark
+def code_warm():
+    run_mila("code", "project")
+    return timed(run_mila, "code", "project")
+
+
+@benchmark
+def parse_sinfo():
+    from milatools.cluster import parse_sinfo
+
+    # Blow the sample up to a cluster of 5000 nodes
+    with open(os.path.join(here, "fixtures", "sinfo.txt")) as f:
+        sample = f.read()
+    output = "".join(sample.replace("cn-", f"cn{i}-") for i in range(500))
+    t0 = time.perf_counter()
+    index = parse_sinfo(output)
+    index.fastest(["--gres=gpu:1", "-p", "main,long"])
+    duration = time.perf_counter() - t0
+    return duration, {"nodes": len(index.nodes)}
+
+
+@benchmark
+def fastest_cached():
+    from milatools.cluster import ClusterIndex
+
+    return timed(ClusterIndex.load, connection())
+
+
+@benchmark
+def sweep_submit():
+    from milatools.sweep import Sweep
+
+    points = [{"lr": 10**-i, "seed": seed} for i in range(10) for seed in range(1000)]
+    sweep = Sweep(connection(), f"bench-{time.time_ns()}")
+    t0 = time.perf_counter()
+    sweep.create(points, ["python", "train.py"], [], 20, 1001, "/tmp")
+    duration = time.perf_counter() - t0
+    return duration, {"arrays": len(sweep.state["arrays"])}
+
+
+@benchmark
+def sync_incremental():
+    from milatools.sync import Sync
+
+    # The fake ssh runs locally, so the "remote" is just another directory
+    src = os.path.join(os.environ["HOME"], f"sync-{time.time_ns()}")
+    for i in range(2000):
+        os.makedirs(os.path.join(src, str(i % 20)), exist_ok=True)
+        with open(os.path.join(src, str(i % 20), f"{i}.py"), "w") as f:
+            f.write(f"x = {i}\n" * 100)
+    sync = Sync(connection(), src, f"{src}-remote")
+    sync.run()
+    for i in range(0, 2000, 200):
+        with open(os.path.join(src, str(i % 20), f"{i}.py"), "a") as f:
+            f.write("y = 1\n")
+    sync = Sync(connection(), src, f"{src}-remote")
+    t0 = time.perf_counter()
+    send, _ = sync.run()
+    duration = time.perf_counter() - t0
+    return duration, {"sent": len(send)}
+
+
+@benchmark
+def transfer_parallel():
+    from milatools.transfer import MB, Transfer
+
+    src = os.path.join(os.environ["HOME"], f"transfer-{time.time_ns()}")
+    os.makedirs(os.path.join(src, "small"))
+    with open(os.path.join(src, "big.bin"), "wb") as f:
+        f.write(os.urandom(64 * MB))
+    for i in range(500):
+        with open(os.path.join(src, "small", f"{i}.txt"), "w") as f:
+            f.write(f"x = {i}\n" * 100)
+    transfer = Transfer(connection(), src, f"{src}-remote", chunk_size=8 * MB)
+    t0 = time.perf_counter()
+    transfer.run()
+    duration = time.perf_counter() - t0
+    return duration, {"mb_per_s": round(transfer.sent / MB / duration, 1)}
+
+
+_connections = {}
+
+
+def connection(shell=False):
+    from milatools.utils import SSHConnection
+
+    if shell not in _connections:
+        _connections[shell] = SSHConnection("bench", shell=shell)
+    return _connections[shell]
+
+
+def run_mila(*argv):
+    from milatools.commands import main
+
+    old_argv = sys.argv
+    sys.argv = ["mila", *argv]
+    try:
+        main()
+    finally:
+        sys.argv = old_argv
+
+
+def setup(tmpdir, latency, auth_latency):
+    """Point HOME, the cache and PATH to tmpdir. Must run before importing milatools."""
+    from shims import install
+
+    os.environ["HOME"] = os.path.join(tmpdir, "home")
+    os.environ["XDG_CACHE_HOME"] = os.path.join(tmpdir, "cache")
+    os.environ["PATH"] = install(os.path.join(tmpdir, "bin")) + ":" + os.environ["PATH"]
+    os.environ["FAKE_SSH_LATENCY"] = str(latency)
+    os.environ["FAKE_SSH_AUTH_LATENCY"] = str(auth_latency)
+    os.environ["FAKE_SINFO_FILE"] = os.path.join(here, "fixtures", "sinfo.txt")
+    os.environ.pop("MILATOOLS_CONTROL_PERSIST", None)
+    os.makedirs(os.environ["HOME"])
+    sys.path.insert(0, root)
+
+
+def run(names, repeat):
+    results = {}
+    with open(os.devnull, "w") as devnull:
+        for name in names:
+            samples, metrics = [], {}
+            for _ in range(repeat):
+                with contextlib.redirect_stdout(devnull):
+                    result = benchmarks[name]()
+                if isinstance(result, tuple):
+                    result, extra = result
+                    for key, value in extra.items():
+                        metrics.setdefault(key, []).append(value)
+                samples.append(result)
+            results[name] = {
+                "median": statistics.median(samples),
+                "min": min(samples),
+                "max": max(samples),
+                **{k: statistics.median(v) for k, v in metrics.items()},
+            }
+            print(format_result(name, results[name]), flush=True)
+    return results
+
+
+def format_result(name, result, baseline=None):
+    line = (
+        f"{name:<18} median {result['median'] * 1000:9.2f}ms"
+        f"   min {result['min'] * 1000:9.2f}ms"
+    )
+    for key, value in result.items():
+        if key not in ("median", "min", "max"):
+            line += f"   {key} {value:,.0f}"
+    if baseline is not None:
+        line += f"   x{result['median'] / baseline['median']:.2f} vs baseline"
+    return line
+
+
+def commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=root,
+            universal_newlines=True,
+            stderr=subprocess.DEVNULL,
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("names", nargs="*", help="Benchmarks to run (default: all)")
+    parser.add_argument("--repeat", type=int, default=10, help="Samples per benchmark")
+    parser.add_argument(
+        "--latency", type=float, default=0.02, help="Simulated round trip (seconds)"
+    )
+    parser.add_argument(
+        "--auth-latency", type=float, default=0.5, help="Simulated handshake (seconds)"
+    )
+    parser.add_argument("--output", help="Save the results to this JSON file")
+    parser.add_argument("--compare", help="Compare to results saved with --output")
+    args = parser.parse_args()
+
+    names = args.names or list(benchmarks)
+    for name in names:
+        if name not in benchmarks:
+            parser.error(
+                f"Unknown benchmark {name}, choose from {', '.join(benchmarks)}"
+            )
+
+    with tempfile.TemporaryDirectory(prefix="milatools-bench-") as tmpdir:
+        setup(tmpdir, args.latency, args.auth_latency)
+        print(f"# commit {commit()}, latency {args.latency}s, {args.repeat} samples")
+        results = run(names, args.repeat)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print(f"# compared to commit {baseline['commit']}")
+        for name, result in results.items():
+            if name in baseline["results"]:
+                print(format_result(name, result, baseline["results"][name]))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(
+                {
+                    "commit": commit(),
+                    "python": platform.python_version(),
+                    "latency": args.latency,
+                    "auth_latency": args.auth_latency,
+                    "repeat": args.repeat,
+                    "results": results,
+                },
+                f,
+                indent=2,
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+"""Fake ssh, Slurm and code executables for the benchmarks.
+
+The fake ssh runs the remote command locally with bash, so the benchmarks
+measure milatools' own overhead plus a simulated network latency. All the
+shims are configured through environment variables:
+
+    FAKE_SSH_LATENCY       Seconds added to every ssh invocation (round trip)
+    FAKE_SSH_AUTH_LATENCY  Seconds added when no master is alive (handshake)
+    FAKE_SSH_FAIL          If set, ssh fails like an unreachable host
+    FAKE_SALLOC_WAIT       Seconds salloc spends in the queue
+    FAKE_SALLOC_HOLD       Seconds salloc holds the allocation once granted
+    FAKE_SALLOC_FAIL       If set, salloc fails with an error instead
+    FAKE_NODE              Node name given by salloc and squeue
+    FAKE_SQUEUE_FILE       File whose contents squeue prints, if set
+    FAKE_SBATCH_FAIL       If set, sbatch refuses jobs
+    FAKE_SINFO_FILE        File whose contents sinfo prints, if set
+    FAKE_SACCT_FILE        File whose contents sacct prints, if set
+
+sbatch prints increasing job ids, kept in $HOME/.fake-jobid, and scancel
+does nothing.
+"""
+
+import os
+import stat
+
+shims = {}
+
+shims["ssh"] = r"""#!/usr/bin/env bash
+sock=""; op=""; master=""; host=""; cmd=()
+while [ $# -gt 0 ]; do
+    if [ ${#cmd[@]} -gt 0 ]; then cmd+=("$1"); shift; continue; fi
+    case "$1" in
+        -O) op="$2"; shift 2;;
+        -S) sock="$2"; shift 2;;
+        -fNMS) master=1; sock="$2"; shift 2;;
+        -L|-R|-D|-p|-J|-l|-i|-o) shift 2;;
+        -*) shift;;
+        *) if [ -z "$host" ]; then host="$1"; else cmd+=("$1"); fi; shift;;
+    esac
+done
+if [ -n "$FAKE_SSH_FAIL" ]; then
+    echo "ssh: connect to host $host port 22: Connection refused" >&2
+    exit 255
+fi
+case "$op" in
+    check) [ -e "$sock" ] && exit 0 || exit 255;;
+    exit) rm -f "$sock"; exit 0;;
+    "") ;;
+    *) exit 0;;
+esac
+if [ -n "$master" ] || [ ! -e "$sock" ]; then
+    sleep "${FAKE_SSH_AUTH_LATENCY:-0}"
+fi
+if [ -n "$master" ]; then
+    touch "$sock"
+    exit 0
+fi
+sleep "${FAKE_SSH_LATENCY:-0}"
+exec bash -c "${cmd[*]}"
+"""
+
+shims["salloc"] = r"""#!/usr/bin/env bash
+echo "salloc: Pending job allocation 1234"
+echo "salloc: job 1234 queued and waiting for resources" >&2
+sleep "${FAKE_SALLOC_WAIT:-0}"
+if [ -n "$FAKE_SALLOC_FAIL" ]; then
+    echo "salloc: error: Job submit/allocate failed: Invalid account" >&2
+    exit 1
+fi
+echo "salloc: Granted job allocation 1234" >&2
+echo "salloc: Nodes ${FAKE_NODE:-cn-a001} are ready for job"
+sleep "${FAKE_SALLOC_HOLD:-0}"
+"""
+
+shims["squeue"] = r"""#!/usr/bin/env bash
+if [ -n "$FAKE_SQUEUE_FILE" ]; then
+    cat "$FAKE_SQUEUE_FILE"
+else
+    echo "${FAKE_NODE:-cn-a001}"
+fi
+"""
+
+shims["sinfo"] = r"""#!/usr/bin/env bash
+if [ -n "$FAKE_SINFO_FILE" ]; then
+    cat "$FAKE_SINFO_FILE"
+fi
+"""
+
+shims["sbatch"] = r"""#!/usr/bin/env bash
+if [ -n "$FAKE_SBATCH_FAIL" ]; then
+    echo "sbatch: error: Batch job submission failed: Invalid account" >&2
+    exit 1
+fi
+jobid=$(( $(cat "$HOME/.fake-jobid" 2>/dev/null || echo 1000) + 1 ))
+echo "$jobid" > "$HOME/.fake-jobid"
+echo "$jobid"
+"""
+
+shims["sacct"] = r"""#!/usr/bin/env bash
+if [ -n "$FAKE_SACCT_FILE" ]; then
+    cat "$FAKE_SACCT_FILE"
+fi
+"""
+
+shims["scancel"] = r"""#!/usr/bin/env bash
+exit 0
+"""
+
+shims["code"] = r"""#!/usr/bin/env bash
+exit 0
+"""
+
+
+def install(bindir):
+    """Write the shims to bindir and return it, to be put first on PATH."""
+    os.makedirs(bindir, exist_ok=True)
+    for name, source in shims.items():
+        path = os.path.join(bindir, name)
+        with open(path, "w") as f:
+            f.write(source)
+        os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR)
+    return bindir
@@ -0,0 +1,133 @@
+import os
+import time
+
+from . import slurm
+from .utils import cachedir, read_json, write_json
+
+# States in which a node can take a new job right away
+available_states = {"idle", "mixed"}
+
+# How long a sinfo snapshot is used, in seconds
+snapshot_ttl = 30
+
+
+class ClusterIndex:
+    """Index of the nodes and partitions of the cluster, built from sinfo.
+
+    Each node is a dict with its name, partitions, state, idle CPUs, free
+    memory (MB), GPU type and number of free GPUs.
+    """
+
+    def __init__(self, nodes, partitions, default_partition=None):
+        self.nodes = nodes
+        self.partitions = partitions
+        self.default_partition = default_partition
+
+    @classmethod
+    def load(cls, ssh):
+        """Build the index from a sinfo snapshot, cached for a few seconds."""
+        path = snapshot_path(ssh.host)
+        snapshot = read_json(path)
+        if snapshot is None or time.time() - snapshot["time"] > snapshot_ttl:
+            snapshot = {"output": ssh.get(slurm.sinfo_command), "time": time.time()}
+            write_json(path, snapshot)
+        return parse_sinfo(snapshot["output"])
+
+    def available(self, request):
+        """Nodes that could run a job with the (parsed) request right now."""
+        gpu_type, gpus = request.get("gpus", (None, 0))
+        memory = request.get("memory", 0)
+        cpus = request.get("cpus", 1)
+        return [
+            node
+            for node in self.nodes.values()
+            if node["state"] in available_states
+            and node["idle_cpus"] >= cpus
+            and node["free_memory"] >= memory
+            and node["free_gpus"] >= gpus
+            and (not gpu_type or node["gpu_type"] == gpu_type)
+        ]
+
+    def fastest(self, options):
+        """Rewrite salloc/sbatch options towards resources that are idle now.
+
+        Among the partitions allowed by the options (the default partition if
+        none are given), pick the partition and GPU type with the most nodes
+        that could start the job right away.
+        """
+        request = slurm.parse_alloc_options(options)
+        if request is None:
+            print("# --fastest: unknown --alloc options, leaving them as is")
+            return options
+        partitions = request.get("partition", self.default_partition or "")
+        allowed = set(partitions.split(",")) if partitions else None
+        wants_gpus = request.get("gpus", (None, 0))[1] > 0
+        # (partition, GPU type) -> [number of nodes, number of free GPUs]
+        groups = {}
+        for node in self.available(request):
+            for partition in node["partitions"]:
+                if allowed is None or partition in allowed:
+                    key = (partition, node["gpu_type"] if wants_gpus else None)
+                    group = groups.setdefault(key, [0, 0])
+                    group[0] += 1
+                    group[1] += node["free_gpus"]
+        if not groups:
+            print("# --fastest: no node can take this job right now")
+            return options
+        (partition, gpu_type), (count, _) = max(groups.items(), key=lambda g: g[1])
+        options = list(options)
+        if allowed is None or len(allowed) > 1:
+            options = slurm.remove_options(options, ["-p", "--partition"])
+            options.append(f"--partition={partition}")
+        gpu_request = request.get("gpus", (None, 0))
+        if wants_gpus and gpu_request[0] is None and gpu_type:
+            options = slurm.remove_options(options, ["--gres", "--gpus", "-G"])
+            options.append(f"--gres=gpu:{gpu_type}:{gpu_request[1]}")
+        print(f"# --fastest: {count} node(s) available for {' '.join(options)}")
+        return options
+
+
+def parse_sinfo(output):
+    """Build a ClusterIndex from the output of slurm.sinfo_command."""
+    nodes = {}
+    partitions = {}
+    default_partition = None
+    nfields = len(slurm.sinfo_fields)
+    for line in output.splitlines():
+        fields = line.split("|")
+        if len(fields) < nfields:
+            continue
+        name, partition, state, cpus, memory, alloc_memory, gres, gres_used = (
+            field.strip() for field in fields[:nfields]
+        )
+        if partition.endswith("*"):
+            partition = default_partition = partition[:-1]
+        partitions.setdefault(partition, []).append(name)
+        if name in nodes:
+            nodes[name]["partitions"].append(partition)
+            continue
+        _, idle_cpus, _, total_cpus = cpus.split("/")
+        gpu_type, gpus = slurm.parse_gpus(gres)
+        _, used_gpus = slurm.parse_gpus(gres_used)
+        nodes[name] = {
+            "name": name,
+            "partitions": [partition],
+            # Flags such as * (not responding) or ~ (powered off) make a node
+            # unavailable
+            "state": state,
+            "idle_cpus": int(idle_cpus),
+            "cpus": int(total_cpus),
+            "free_memory": _int(memory) - _int(alloc_memory),
+            "gpu_type": gpu_type,
+            "gpus": gpus,
+            "free_gpus": gpus - used_gpus,
+        }
+    return ClusterIndex(nodes, partitions, default_partition)
+
+
+def snapshot_path(host):
+    return os.path.join(cachedir, "cluster", f"{host}.json")
+
+
+def _int(value):
+    return int(value) if value.isdigit() else 0
@@ -0,0 +1,103 @@
+import os
+
+import pytest
+
+from milatools import cluster
+from milatools.cluster import ClusterIndex, parse_sinfo
+
+fixture = os.path.join(
+    os.path.dirname(__file__), "..", "benchmarks", "fixtures", "sinfo.txt"
+)
+
+
+@pytest.fixture
+def sinfo():
+    with open(fixture) as f:
+        return f.read()
+
+
+@pytest.fixture
+def index(sinfo):
+    return parse_sinfo(sinfo)
+
+
+def test_parse_sinfo_partitions(index):
+    assert index.default_partition == "main"
+    assert index.partitions["main"] == ["cn-a001", "cn-a002", "cn-b001", "cn-b002"]
+    assert index.partitions["cpu"] == ["cn-f001", "cn-f002"]
+    assert index.nodes["cn-a001"]["partitions"] == ["main", "long"]
+
+
+def test_parse_sinfo_resources(index):
+    assert index.nodes["cn-a001"] == {
+        "name": "cn-a001",
+        "partitions": ["main", "long"],
+        "state": "mixed",
+        "idle_cpus": 24,
+        "cpus": 40,
+        "free_memory": 386000 - 98304,
+        "gpu_type": "rtx8000",
+        "gpus": 8,
+        "free_gpus": 4,
+    }
+    # No GPUs, (null) gres
+    assert index.nodes["cn-f001"]["gpu_type"] is None
+    assert index.nodes["cn-f001"]["free_gpus"] == 0
+    # Flags are kept, so that the node is not available
+    assert index.nodes["cn-c003"]["state"] == "idle*"
+
+
+def test_parse_sinfo_skips_garbage():
+    index = parse_sinfo("sinfo: error: some warning\n\n")
+    assert index.nodes == {}
+
+
+def test_available(index):
+    nodes = index.available({"gpus": ("a100l", 2)})
+    assert [node["name"] for node in nodes] == ["cn-c002"]
+
+
+@pytest.mark.parametrize(
+    "options, expected",
+    [
+        # The default partition, with the GPU type that has the most free GPUs
+        (["--gres=gpu:1"], ["--gres=gpu:v100:1"]),
+        # Two long nodes have a free a100l, only one node of each type in main
+        (
+            ["--gres=gpu:1", "-p", "main,long"],
+            ["--partition=long", "--gres=gpu:a100l:1"],
+        ),
+        # A fixed partition and GPU type are left alone
+        (["-p", "long", "--gres=gpu:a100l:2"], ["-p", "long", "--gres=gpu:a100l:2"]),
+        (["-c", "8"], ["-c", "8"]),
+        # Nothing can take the job right now
+        (["--gres=gpu:9"], ["--gres=gpu:9"]),
+        # Options we cannot compare
+        (["--gres=gpu:1", "--exclusive"], ["--gres=gpu:1", "--exclusive"]),
+    ],
+)
+def test_fastest(index, options, expected):
+    assert index.fastest(options) == expected
+
+
+class FakeConnection:
+    host = "fake"
+
+    def __init__(self, output):
+        self.output = output
+        self.calls = 0
+
+    def get(self, *args):
+        self.calls += 1
+        return self.output
+
+
+def test_load_caches_snapshot(sinfo, tmp_path, monkeypatch):
+    monkeypatch.setattr(cluster, "cachedir", str(tmp_path))
+    ssh = FakeConnection(sinfo)
+    assert len(ClusterIndex.load(ssh).nodes) == 10
+    assert len(ClusterIndex.load(ssh).nodes) == 10
+    assert ssh.calls == 1
+    monkeypatch.setattr(cluster, "snapshot_ttl", -1)
+    ClusterIndex.load(ssh)
+    assert ssh.calls == 2
@@ -1,17 +1,63 @@
+import json
 import os
+import re
 import shlex
 import subprocess
+import sys
+import threading
+import time
 import webbrowser
 
-from coleo import Option, auto_cli, default, tooled
-
-from .utils import Local, SSHConfig, SSHConnection, T, yn
+from coleo import Option, default, make_cli, tooled
+
+from . import hostlist, slurm, vscode
+from .cluster import ClusterIndex, snapshot_path
+from .facts import HostFacts, facts_path
+from .forward import Forwards
+from .logs import LogStream
+from .pool import AllocationPool
+from .sessions import Sessions, live_jobs
+from .sweep import Sweep, load_spec
+from .sync import Sync
+from .trace import tracer
+from .transfer import MB, Transfer
+from .utils import Local, SSHConfig, T, connections, read_json, yn
 from .version import version as mversion
 
+# Names of the jobs that mila code may offer to reuse: its own placeholder
+# jobs and salloc's interactive jobs
+reusable_job_names = {"mila-code", "interactive"}
+
+# Servers for mila serve: name -> (command run on the node, pattern of the
+# line that gives the server's URL and port)
+servers = {
+    "jupyter": (
+        "jupyter lab --no-browser --ip=0.0.0.0",
+        r".*(http://[^\s/]+:([0-9]+)/\S*token=\S+)",
+    ),
+    "tensorboard": (
+        "tensorboard --bind_all --port $(python -c 'import socket; s = socket.socket();"
+        ' s.bind(("", 0)); print(s.getsockname()[1])\')',
+        r".*(http://[^\s/]+:([0-9]+)/\S*)",
+    ),
+}
+
 
 def main():
     """Entry point for milatools."""
-    auto_cli(milatools)
+    opts, run = make_cli(milatools, extras=[_trace_options])
+    trace_file = getattr(opts, "trace_file", None)
+    tracer.enabled = getattr(opts, "trace", False) or trace_file is not None
+    try:
+        result = run()
+        if result is not None:
+            print(result)
+    finally:
+        if getattr(opts, "trace", False):
+            tracer.report()
+        if trace_file is not None:
+            tracer.dump(trace_file)
+            print(f"Wrote the trace to {trace_file}")
 
 
 class milatools:
@@ -163,11 +209,17 @@ class milatools:
 
         print("Checking connection to compute nodes")
 
-        ssh = SSHConnection("mila")
-        try:
-            pubkeys = ssh.get("ls -t ~/.ssh/id*.pub").strip().split()
+        ssh = connections.get("mila")
+        keys, common = ssh.get_many(
+            [
+                "ls -t ~/.ssh/id*.pub",
+                "comm -12 <(sort ~/.ssh/authorized_keys) <(sort ~/.ssh/*.pub)",
+            ]
+        )
+        if keys.returncode == 0:
+            pubkeys = keys.stdout.strip().split()
             print("# OK")
-        except subprocess.CalledProcessError:
+        else:
             print("# MISSING")
             if yn("You have no public keys on the login node. Generate them?"):
                 # print("(Note: You can just press Enter 3x to accept the defaults)")
@@ -178,10 +230,7 @@ class milatools:
             else:
                 exit("Cannot proceed because there is no public key")
 
-        common = ssh.get(
-            "comm -12 <(sort ~/.ssh/authorized_keys) <(sort ~/.ssh/*.pub)", bash=True
-        ).strip()
-        if common:
+        if common.stdout.strip():
             print("# OK")
         else:
             print("# MISSING")
@@ -197,61 +246,761 @@ class milatools:
         # [positional]
         path: Option
 
-        ssh = SSHConnection("mila")
+        ssh = connections.get("mila")
         here = Local()
-
-        proc, node_name = _find_allocation(ssh)
-
-        if not path.startswith("/"):
-            # Get $HOME because we have to give the full path to code
-            home = ssh.get("echo $HOME").strip()
-            print("#", home)
-            path = os.path.join(home, path)
-
-        here.run("code", "--remote", f"ssh-remote+{node_name}.server.mila.quebec", path)
+        sessions = Sessions()
+
+        # The quick checks come first, so that their output does not get
+        # mixed with the allocation's (a cold cache fetches all the facts,
+        # including the arch used below, in a single round trip)
+        _check_ssh_config()
+        remote_path = _remote_path(ssh, path)
+
+        # The VSCode server is pushed quietly while waiting for the
+        # allocation, in a daemon thread so that Ctrl+C does not wait for a
+        # download or a push to finish
+        staged = []
+        staging = threading.Thread(
+            target=lambda: staged.append(_prepare_vscode_server(ssh, here, quiet=True)),
+            daemon=True,
+        )
+        staging.start()
+        proc, allocation = _find_allocation(ssh, sessions.find("code", path))
+        staging.join()
+        if staged and staged[0]:
+            print(staged[0])
+        node_name = allocation["node"]
+
+        if allocation["job"] is not None:
+            sessions.add(
+                {
+                    **allocation,
+                    "kind": "code",
+                    "path": path,
+                    "host": ssh.host,
+                    "socket": ssh.sock,
+                    "forwards": [],
+                }
+            )
+
+        here.run(
+            "code",
+            "--remote",
+            f"ssh-remote+{node_name}.server.mila.quebec",
+            remote_path,
+        )
 
         try:
             if proc is not None:
                 proc.wait()
         except KeyboardInterrupt:
             print(f"Ended session on '{node_name}'")
-            ssh.cleanup()
             exit()
 
+    def alloc():
+        """Keep a pool of allocations ready for mila code."""
+        # Number of jobs to keep ready (0 releases the pool)
+        keep: Option & int = default(None)
+
+        # Time limit of each job in the pool
+        time_limit: Option = default("2:00:00")
+
+        # Release the pool after this many minutes without mila code using it
+        idle: Option & int = default(60)
+
+        # Extra options to pass to sbatch
+        # [nargs: --]
+        alloc: Option = default([])
+
+        ssh = connections.get("mila")
+        pool = AllocationPool(ssh)
+        if keep is not None:
+            pool.configure(keep, alloc, time_limit, idle * 60)
+        jobs = pool.refill()
+
+        if not jobs:
+            print("# The pool is empty")
+        for job in jobs:
+            print(f"{job['jobid']:>10}  {job['state']:<10} {job.get('nodes', '')}")
+
+    def forward():
+        """Forward local ports to ports on a compute node, or list the forwards."""
+        # Node to forward to
+        # [positional: ?]
+        node: Option
+
+        # Ports to forward
+        # [positional: *]
+        ports: Option & int
+
+        # Cancel the forwards to the node and ports (all of them by default)
+        cancel: Option & bool = default(False)
+
+        ssh = connections.get("mila")
+        forwards = Forwards(ssh)
+        if cancel:
+            for forward in forwards.cancel(node, ports):
+                print(f"# Cancelled {_format_forward(forward)}")
+            return
+        if (ports and node is None) or (node or "").isdigit():
+            exit("ERROR: Which node should the ports be forwarded to?")
+        for port in ports:
+            forwards.add(node, port)
+        for forward in forwards.live():
+            if node in (None, forward["node"]):
+                print(_format_forward(forward))
+
+    def jobs():
+        """Show your jobs, or watch them and print their changes."""
+        # Keep polling and print the jobs' changes (state, reason, nodes)
+        watch: Option & bool = default(False)
+
+        # Print one JSON object per line
+        jsonl: Option & bool = default(False)
+
+        # Seconds between polls while jobs change
+        interval: Option & float = default(2)
+
+        # Seconds between polls when nothing changes for a while
+        max_interval: Option & float = default(60)
+
+        ssh = connections.get("mila", shell=watch)
+        if not watch:
+            jobs = slurm.parse_squeue(ssh.get(slurm.squeue_command(), quiet=jsonl))
+            for job in jobs:
+                print(json.dumps(job) if jsonl else _format_job(job))
+            return
+
+        try:
+            for event in slurm.watch_jobs(ssh, interval, max_interval):
+                print(json.dumps(event) if jsonl else _format_event(event), flush=True)
+        except KeyboardInterrupt:
+            pass
+
+    def logs():
+        """Show the output of a job."""
+        # Job ID
+        # [positional]
+        job: Option
+
+        # Keep printing new lines until the job ends
+        # [alias: -f]
+        follow: Option & bool = default(False)
+
+        # Number of lines to show from the end of the logs
+        # [alias: -n]
+        lines: Option & int = default(10)
+
+        ssh = connections.get("mila")
+        try:
+            output = ssh.get(shlex.join(["scontrol", "show", "job", job]))
+        except subprocess.CalledProcessError:
+            exit(f"ERROR: Could not find job {job}")
+        fields = slurm.parse_scontrol(output)
+        paths = list(
+            dict.fromkeys(filter(None, [fields.get("StdOut"), fields.get("StdErr")]))
+        )
+        if not paths:
+            # Interactive jobs (salloc, srun --pty) write to the terminal
+            exit(f"ERROR: Job {job} has no log files, is it an interactive job?")
+        if len(paths) == 1:
+            labels = {paths[0]: ""}
+        else:
+            labels = {paths[0]: T.cyan("out| "), paths[1]: T.red("err| ")}
+        # A job that already ended has nothing more to follow
+        running = fields.get("JobState") in ("PENDING", "RUNNING")
+        stream = LogStream(ssh, paths, lines, follow and running, job)
+        try:
+            for path, line in stream:
+                if path is None:
+                    print(T.bold_yellow(f"# {line}"), file=sys.stderr)
+                else:
+                    print(f"{labels[path]}{line}", flush=follow)
+        except KeyboardInterrupt:
+            pass
+
+    def run():
+        """Submit a command over a sweep of parameters, as Slurm job arrays."""
+        # Sweep file: a list of parameter sets, or lists of values to combine
+        # (yaml, json or csv)
+        # [positional]
+        spec: Option
+
+        # Command to run for each parameter set, given as --name=value options
+        # [remainder]
+        command: Option
+
+        # Name of the sweep (default: the name of the sweep file)
+        name: Option = default(None)
+
+        # Maximum number of running tasks in each array
+        throttle: Option & int = default(None)
+
+        # Maximum number of tasks in each array (default: MaxArraySize)
+        chunk: Option & int = default(None)
+
+        # Submit the failed tasks of the sweep again
+        resubmit: Option & bool = default(False)
+
+        # Extra options to pass to sbatch
+        # [nargs: --]
+        alloc: Option = default([])
+
+        ssh = connections.get("mila")
+        name = name or os.path.splitext(os.path.basename(spec))[0]
+        sweep = Sweep(ssh, name)
+
+        if resubmit:
+            if sweep.state is None:
+                exit(f"ERROR: There is no sweep named '{name}'")
+            sweep.resubmit()
+            return
+        if sweep.state is not None:
+            exit(f"ERROR: A sweep named '{name}' exists, use --name or --resubmit")
+        if not command:
+            exit("ERROR: No command to run")
+
+        points = load_spec(spec)
+        facts = HostFacts(ssh)
+        if chunk is None:
+            try:
+                chunk = int(facts.get("max_array_size"))
+            except (KeyError, ValueError):
+                # Slurm's default
+                chunk = 1001
+        sweep.create(points, command, alloc, throttle, chunk, facts.get("home"))
+
+    def vscode():
+        """Show the VSCode server builds on the cluster, or prune old ones."""
+        # Remove the old builds, except the one for your local VSCode
+        prune: Option & bool = default(False)
+
+        # Number of recent builds to keep when pruning
+        keep: Option & int = default(2)
+
+        ssh = connections.get("mila")
+        builds = vscode.builds(ssh)
+        commit = vscode.local_commit(Local())
+        if prune:
+            builds = vscode.prune(ssh, builds, keep, commit)
+        for build in builds:
+            mark = " (local VSCode)" if vscode.commit_of(build) == commit else ""
+            print(f"~/.vscode-server/{build}{mark}")
+
+    def serve():
+        """Start Jupyter or TensorBoard on a compute node and open it locally."""
+        # Server to start: jupyter or tensorboard
+        # [positional]
+        server: Option
+
+        # Extra arguments for the server
+        # [remainder]
+        args: Option
+
+        # Directory to start the server in, relative to $HOME
+        path: Option = default(".")
+
+        if server not in servers:
+            exit(f"ERROR: Unknown server '{server}' (use {' or '.join(servers)})")
+        command, pattern = servers[server]
+
+        ssh = connections.get("mila")
+        proc, allocation = _find_allocation(ssh)
+        node_name = allocation["node"]
+        forwards = Forwards(ssh)
+        sessions = Sessions()
+        opened = []
+
+        def open_server(m):
+            if not opened:
+                forward = forwards.add(node_name, int(m.group(2)))
+                opened.append(forward)
+                if allocation["job"] is not None:
+                    sessions.add(
+                        {
+                            **allocation,
+                            "kind": "serve",
+                            "path": server,
+                            "host": ssh.host,
+                            "socket": ssh.sock,
+                            "forwards": opened,
+                        }
+                    )
+                url = re.sub(r"//[^/]+", f"//localhost:{forward['local']}", m.group(1))
+                print(f"Opening {server}: {url}")
+                webbrowser.open(url)
+
+        script = f"cd {shlex.quote(path)} && exec {command} {shlex.join(args)}"
+        try:
+            # The server is kept running and its output printed until it
+            # exits or Ctrl+C is pressed
+            ssh.extract(
+                shlex.join(
+                    ["ssh", "-tt", node_name, shlex.join(["bash", "-lc", script])]
+                ),
+                patterns={pattern: open_server},
+                wait=True,
+            )
+        finally:
+            for forward in opened:
+                forwards.cancel(node_name, [forward["port"]])
+            sessions.remove(
+                [
+                    s
+                    for s in sessions.sessions
+                    if s["kind"] == "serve" and s["job"] == allocation["job"]
+                ]
+            )
+            if proc is not None:
+                proc.terminate()
+
+    def sessions():
+        """List the sessions of mila code and mila serve, or end them."""
+        # Job ID of the session to end (which cancels its job), or all
+        kill: Option = default(None)
+
+        ssh = connections.get("mila")
+        registry = Sessions()
+        jobs = registry.refresh(ssh)
+
+        if kill is not None:
+            ended = [s for s in registry.sessions if kill in ("all", s["job"])]
+            if not ended:
+                exit(f"ERROR: There is no session with job {kill}")
+            forwards = Forwards(ssh)
+            for session in ended:
+                for forward in session["forwards"]:
+                    forwards.cancel(session["node"], [forward["port"]])
+            ssh.get(shlex.join(["scancel", *[s["job"] for s in ended]]))
+            registry.remove(ended)
+            for session in ended:
+                print(
+                    f"# Ended the session of job {session['job']} on {session['node']}"
+                )
+            return
+
+        if not registry.sessions:
+            print("# No sessions")
+        now = time.time()
+        for session in registry.sessions:
+            job = jobs[session["job"]]
+            age = _format_duration(now - session["start"])
+            print(
+                f"{session['job']:>10}  {session['node']:<10} {job['state']:<10}"
+                f" {session['kind']:<6} {session['path']}  (started {age} ago,"
+                f" {job['time_left']} left)"
+            )
+
+    def sync():
+        """Copy a local directory to the cluster, sending only what changed."""
+        # Local directory
+        # [positional]
+        local: Option
+
+        # Directory on the cluster (relative to $HOME unless absolute)
+        # [positional]
+        remote: Option
+
+        # Host to copy to
+        host: Option = default("mila")
+
+        # Do not send the files that match this pattern (may be repeated)
+        # [action: append]
+        exclude: Option = default([])
+
+        # Delete the remote files that do not exist locally
+        delete: Option & bool = default(False)
+
+        # Only print what would be sent and deleted
+        dry_run: Option & bool = default(False)
+
+        if not os.path.isdir(local):
+            exit(f"ERROR: {local} is not a directory")
+        Sync(connections.get(host), local, remote, exclude).run(delete, dry_run)
+
+    def transfer():
+        """Copy a large file or dataset to the cluster over parallel streams."""
+        # Local file or directory
+        # [positional]
+        local: Option
+
+        # Directory on the cluster to copy into
+        # [positional]
+        remote: Option
+
+        # Host to copy to
+        host: Option = default("mila")
+
+        # Number of parallel streams to start with
+        channels: Option & int = default(4)
+
+        # Maximum number of parallel streams (sshd allows 10 sessions per
+        # connection by default)
+        max_channels: Option & int = default(8)
+
+        # Size of the pieces that large files are split into, in MB
+        chunk_size: Option & int = default(256)
+
+        if not os.path.exists(local):
+            exit(f"ERROR: {local} does not exist")
+        Transfer(
+            connections.get(host),
+            local,
+            remote,
+            channels=channels,
+            max_channels=max_channels,
+            chunk_size=chunk_size * MB,
+        ).run()
+
+    def cache():
+        """Show or clear the cached facts about the cluster."""
+        # Host whose facts to show or clear
+        host: Option = default("mila")
+
+        # Remove the cached facts so that they are fetched again
+        clear: Option & bool = default(False)
+
+        path = facts_path(host)
+        if clear:
+            for cached in (path, snapshot_path(host)):
+                if os.path.exists(cached):
+                    os.remove(cached)
+            print(f"Cleared the cached facts about {host}")
+            return
+
+        now = time.time()
+        for name, entry in read_json(path, default={}).items():
+            age = int(now - entry["time"])
+            print(T.bold(f"{name}"), f"(cached {age}s ago)")
+            if (value := entry["value"]) is None:
+                print("# UNAVAILABLE")
+            elif len(lines := value.splitlines()) > 5:
+                print("\n".join(lines[:5]))
+                print(f"# ... {len(lines) - 5} more lines")
+            else:
+                print(value)
+
 
 @tooled
-def _find_allocation(ssh):
+def _find_allocation(ssh, session=None):
+    """Get a node, returns (proc, allocation).
+
+    proc is the process holding the allocation, if any, and allocation holds
+    the job id (if known), the node and the --alloc options. session is a
+    previous session to reattach to if its job is still running.
+    """
     # Node to connect to
     node: Option = default(None)
 
     # Job ID to connect to
     job: Option = default(None)
 
-    # Extra options to pass to slurm
+    # Extra options to pass to slurm. Separate several sets of options
+    # with --or to request all of them and keep the first one granted
     # [nargs: --]
     alloc: Option = default([])
 
+    # Node to open in a multi-node job: first, load (the least loaded
+    # one) or its rank in the job's node list (0, 1, ...)
+    select: Option = default("first")
+
+    # Allocate with a placeholder sbatch job that keeps running when
+    # the connection drops, instead of salloc
+    detached: Option & bool = default(False)
+
+    # Steer the allocation towards the partition and GPU type with the
+    # most idle nodes right now
+    fastest: Option & bool = default(False)
+
+    # Attach to a running job with matching resources without asking
+    # [false-options]
+    # [false-options-doc: Always start a new allocation]
+    reuse: Option & bool = default(None)
+
     if (node is not None) + (job is not None) + bool(alloc) > 1:
         exit("ERROR: --node, --job and --alloc are mutually exclusive")
 
+    candidates = _split_alternatives(alloc)
+    proc = None
+    jobid = job
+
     if node is not None:
-        proc = None
         node_name = node
 
     elif job is not None:
-        proc = None
         node_name = ssh.get(f"squeue --jobs {job} -ho %N").strip()
         print("#", node_name)
 
+    elif (
+        session is not None
+        and reuse is not False
+        and (not alloc or alloc == session["alloc"])
+        and (live := _live_session(ssh, session))
+    ):
+        jobid, node_name = live["jobid"], session["node"]
+        print(f"# Reattaching to job {jobid} on {node_name}")
+
+    elif live := _pool_job(ssh, candidates) or (
+        reuse is not False and _reusable_job(ssh, candidates, ask=reuse is None)
+    ):
+        jobid, node_name = live["jobid"], live["nodes"]
+
+    elif detached or len(candidates) > 1:
+        if fastest:
+            candidates = _fastest(ssh, candidates)
+        live = _detached_allocation(ssh, candidates)
+        jobid, node_name = live["jobid"], live["nodes"]
+
     else:
-        node_name = None
+        if fastest:
+            candidates = _fastest(ssh, candidates)
+        (options,) = candidates
+        jobids = []
         proc, node_name = ssh.extract(
-            shlex.join(["salloc", *alloc]),
-            pattern="salloc: Nodes ([^ ]+) are ready for job\n",
+            shlex.join(["salloc", *options]),
+            patterns={
+                "salloc: Granted job allocation ([0-9]+)": (
+                    lambda m: jobids.append(m.group(1))
+                ),
+                "salloc: Nodes ([^ ]+) are ready for job\n": lambda m: m.group(1),
+                "salloc: error: (.*)": lambda m: exit(f"ERROR: {m.group(1)}"),
+                "salloc: (Job allocation [0-9]+ has been revoked.*)": (
+                    lambda m: exit(f"ERROR: {m.group(1)}")
+                ),
+            },
             bash=True,  # Some zsh or fish shells may be improperly configured for salloc
         )
+        jobid = jobids[0] if jobids else None
 
-    if node_name is None:
+    if not node_name:
+        # squeue prints no nodes for a pending job
+        if jobid is not None:
+            exit(f"ERROR: job {jobid} has no node yet")
         exit("ERROR: Could not find the node name for the allocation")
 
-    return proc, node_name
+    node_name = _select_node(ssh, node_name, select)
+    return proc, {"job": jobid, "node": node_name, "alloc": alloc}
+
+
+def _select_node(ssh, nodelist, select):
+    """Pick one node out of a Slurm hostlist, e.g. cn-a[001-004]."""
+    nodes = hostlist.expand(nodelist)
+    if len(nodes) == 1:
+        return nodes[0]
+    if select == "first":
+        node = nodes[0]
+    elif select == "load":
+        node = _least_loaded(ssh, nodes)
+    elif select.isdigit() and int(select) < len(nodes):
+        node = nodes[int(select)]
+    else:
+        exit(f"ERROR: --select must be first, load or a rank below {len(nodes)}")
+    print(f"# Using {node} out of {nodelist}")
+    return node
+
+
+def _least_loaded(ssh, nodes):
+    """Probe the load average of all nodes in parallel, in one round trip."""
+    probe = "ssh -oBatchMode=yes -oConnectTimeout=5 {} cat /proc/loadavg"
+    script = " ".join(f"(echo {n} $({probe.format(n)})) &" for n in nodes)
+    loads = {}
+    for line in ssh.get(f"{script} wait", bash=True).splitlines():
+        node, *fields = line.split()
+        if fields:
+            loads[node] = float(fields[0])
+            print(f"# {node}: load {fields[0]}")
+    return min(nodes, key=lambda node: loads.get(node, float("inf")))
+
+
+def _split_alternatives(alloc):
+    """Split --alloc options on --or, e.g. [-p long --or -p main]."""
+    candidates = [[]]
+    for arg in alloc:
+        if arg == "--or":
+            candidates.append([])
+        else:
+            candidates[-1].append(arg)
+    return candidates
+
+
+def _fastest(ssh, candidates):
+    index = ClusterIndex.load(ssh)
+    return [index.fastest(options) for options in candidates]
+
+
+def _pool_job(ssh, candidates):
+    """Take a running job from the pool and refill the pool in the background."""
+    pool = AllocationPool(ssh)
+    if not pool.state["jobs"]:
+        return None
+    if pool.idle():
+        print("# Releasing the pool, which was not used for its idle period")
+        pool.refill()
+        return None
+    if not (job := pool.take(candidates)):
+        return None
+    print(f"# Using job {job['jobid']} from the pool")
+    _print_detached(job["jobid"])
+    subprocess.Popen(
+        [sys.executable, "-c", "from milatools.commands import main; main()", "alloc"],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        start_new_session=True,
+    )
+    return job
+
+
+def _detached_allocation(ssh, candidates):
+    """Submit a placeholder job per set of options and wait until one runs.
+
+    The other jobs are cancelled as soon as one of them is running. Returns
+    the job that won.
+    """
+    commands = [slurm.placeholder_command(c, "mila-code") for c in candidates]
+    jobids = []
+    for result in ssh.get_many(commands):
+        if result.returncode == 0:
+            jobids.append(slurm.parse_sbatch(result.stdout))
+        else:
+            print(result.stderr.strip())
+    if not jobids:
+        exit("ERROR: Could not submit the job")
+    print(f"# Submitted job(s) {', '.join(jobids)}")
+    job = None
+    try:
+        job = slurm.wait_running(slurm.JobSnapshots(ssh), jobids)
+    except KeyboardInterrupt:
+        exit("Canceled")
+    finally:
+        if losers := [jobid for jobid in jobids if not job or jobid != job["jobid"]]:
+            ssh.get(shlex.join(["scancel", *losers]))
+    if job is None:
+        exit(f"ERROR: Job(s) {', '.join(jobids)} ended before running")
+    _print_detached(job["jobid"])
+    return job
+
+
+def _print_detached(jobid):
+    print(
+        f"# Job {jobid} keeps running until its time limit"
+        f" (scancel {jobid} to release it)"
+    )
+
+
+def _reusable_job(ssh, candidates, ask):
+    """Find a running interactive job whose resources satisfy a set of options.
+
+    Only the jobs started by mila code or salloc are considered, so that
+    batch jobs (e.g. the tasks of a sweep) are never taken over.
+    """
+    requests = [slurm.parse_alloc_options(c) for c in candidates]
+    if not (requests := [r for r in requests if r is not None]):
+        return None
+    matches = [
+        job
+        for job in slurm.parse_squeue(ssh.get(slurm.squeue_command("-t", "RUNNING")))
+        if job["name"] in reusable_job_names
+        and any(slurm.job_matches(job, request) for request in requests)
+    ]
+    if not matches:
+        return None
+    job = matches[0]
+    if ask:
+        for other in matches[1:]:
+            print(f"# Job {other['jobid']} ({other['name']}) on {other['nodes']}")
+        if not yn(
+            f"Job {job['jobid']} ({job['name']}) is already running on"
+            f" {job['nodes']} with enough resources"
+            + (f" ({len(matches) - 1} others above)" if len(matches) > 1 else "")
+            + ". Use it?"
+        ):
+            return None
+    print(f"# Reusing job {job['jobid']} on {job['nodes']}")
+    return job
+
+
+def _live_session(ssh, session):
+    """The job of a previous session if it is still running on the same node."""
+    if session["job"] is None:
+        return None
+    job = live_jobs(ssh, [session["job"]]).get(session["job"])
+    if job is None or job["state"] != "RUNNING":
+        return None
+    if session["node"] not in hostlist.expand(job["nodes"]):
+        return None
+    return job
+
+
+def _remote_path(ssh, path):
+    if path.startswith("/"):
+        return path
+    # Get $HOME because we have to give the full path to code
+    home = HostFacts(ssh).get("home")
+    print("#", home)
+    return os.path.join(home, path)
+
+
+def _prepare_vscode_server(ssh, here, quiet=False):
+    """Push the VSCode server for the local commit, so nodes need not fetch it.
+
+    Returns a message about what was done, if anything.
+    """
+    if (commit := vscode.local_commit(here, quiet)) is None:
+        return None
+    exec_server = vscode.uses_exec_server()
+    if vscode.installed(ssh, commit, exec_server, quiet):
+        return None
+    try:
+        arch = HostFacts(ssh).get("arch", quiet)
+        vscode.stage(ssh, commit, vscode.archs.get(arch, arch), exec_server, quiet)
+    except (OSError, KeyError, subprocess.CalledProcessError) as err:
+        return T.bold_yellow(f"# Could not stage the VSCode server: {err}")
+    return f"# Staged the VSCode server for {commit} on {ssh.host}"
+
+
+def _check_ssh_config():
+    path = os.path.expanduser("~/.ssh/config")
+    if (
+        not os.path.exists(path)
+        or "*.server.mila.quebec" not in SSHConfig(path).hosts()
+    ):
+        print(
+            T.bold_yellow("# ~/.ssh/config has no entry for the nodes, run mila init")
+        )
+
+
+def _format_duration(seconds):
+    minutes, hours = int(seconds) // 60, int(seconds) // 3600
+    return f"{hours}h{minutes % 60:02d}" if hours else f"{minutes}m"
+
+
+def _format_forward(forward):
+    return f"http://localhost:{forward['local']} -> {forward['node']}:{forward['port']}"
+
+
+def _format_job(job, state=None, details=None):
+    if details is None:
+        details = job["nodes"] if job["state"] == "RUNNING" else f"({job['reason']})"
+    state = state or job["state"]
+    return f"{job['jobid']:>12}  {job['name'][:20]:<20} {state:<10} {details}"
+
+
+def _format_event(event):
+    state = event["state"]
+    if (previous := event.get("previous")) and previous["state"] != state:
+        state = f"{previous['state']} -> {state}"
+    details = f"exit {event['exit_code']}" if event["event"] == "ended" else None
+    return f"{event['time'][11:]}  {_format_job(event, state, details)}"
+
+
+@tooled
+def _trace_options():
+    # Options available on every command, read by main()
+
+    # Print a timeline of the local and remote commands that were run
+    trace: Option & bool = default(False)
+
+    # Write the timeline to this file (Chrome trace format, viewable
+    # in chrome://tracing or https://ui.perfetto.dev)
+    # [metavar: FILE]
+    trace_file: Option = default(None)
@@ -0,0 +1,68 @@
+import os
+import time
+
+from .utils import cachedir, read_json, write_json
+
+minute = 60
+hour = 60 * minute
+day = 24 * hour
+
+# Stable facts about a host: name -> (command, time to live in seconds)
+facts = {
+    # To give code the full path to open
+    "home": ("echo $HOME", 30 * day),
+    # To push the right VSCode server build
+    "arch": ("uname -m", 30 * day),
+    # Largest job array index + 1, to split sweeps in mila run
+    "max_array_size": (
+        "scontrol show config | sed -n 's/^MaxArraySize *= *//p'",
+        day,
+    ),
+}
+
+
+class HostFacts:
+    """On-disk cache of facts about a host, in ~/.cache/milatools/facts/.
+
+    When a fact is missing or expired, all the stale facts are fetched again
+    in a single round trip.
+    """
+
+    def __init__(self, connection):
+        self.ssh = connection
+        self.path = facts_path(connection.host)
+
+    def entries(self):
+        return read_json(self.path, default={})
+
+    def stale(self, entries):
+        now = time.time()
+        return [
+            name
+            for name, (_, ttl) in facts.items()
+            if name not in entries or now - entries[name]["time"] > ttl
+        ]
+
+    def refresh(self, names, quiet=False):
+        entries = self.entries()
+        results = self.ssh.get_many([facts[name][0] for name in names], quiet=quiet)
+        now = time.time()
+        for name, result in zip(names, results):
+            # Failures are cached too (e.g. sinfo on a compute node), so that
+            # they do not trigger a round trip on every call
+            value = result.stdout.strip() if result.returncode == 0 else None
+            entries[name] = {"value": value, "time": now}
+        write_json(self.path, entries)
+        return entries
+
+    def get(self, name, quiet=False):
+        entries = self.entries()
+        if name in (stale := self.stale(entries)):
+            entries = self.refresh(stale, quiet)
+        if (value := entries[name]["value"]) is None:
+            raise KeyError(f"Could not get {name} from {self.ssh.host}")
+        return value
+
+
+def facts_path(host):
+    return os.path.join(cachedir, "facts", f"{host}.json")
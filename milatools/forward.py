@@ -0,0 +1,70 @@
+import os
+
+from .utils import cachedir, free_port, read_json, write_json
+
+forwards_path = os.path.join(cachedir, "forwards.json")
+
+
+class Forwards:
+    """Port forwards added to the control master of a host by mila forward.
+
+    ssh cannot list the forwards of a master, so they are kept in
+    ~/.cache/milatools/forwards.json. They last as long as the master: the
+    list is cleared when it is found dead.
+    """
+
+    def __init__(self, ssh, path=forwards_path):
+        self.ssh = ssh
+        self.path = path
+        self.state = read_json(path, default={})
+        if ssh.master is not None:
+            # A new master was started, the old one took its forwards along
+            self.state[ssh.host] = []
+            self.save()
+
+    def save(self):
+        write_json(self.path, self.state)
+
+    def live(self):
+        forwards = self.state.get(self.ssh.host, [])
+        if forwards and not self.ssh.check():
+            forwards = self.state[self.ssh.host] = []
+            self.save()
+        return forwards
+
+    def add(self, node, port, local_port=None):
+        """Forward a local port to port on node, returns the new entry.
+
+        An existing forward to the same node and port is reused.
+        """
+        forwards = self.live()
+        for forward in forwards:
+            if forward["node"] == node and forward["port"] == port:
+                return forward
+        if local_port is None and port in [f["local"] for f in forwards]:
+            # Another node's forward already took the same port number
+            local_port = free_port()
+        local_port = self.ssh.forward(port, node, local_port)
+        forward = {"node": node, "port": port, "local": local_port}
+        self.state[self.ssh.host] = [*forwards, forward]
+        self.save()
+        return forward
+
+    def cancel(self, node=None, ports=()):
+        """Cancel the forwards to node (any node if None) and ports (any if empty).
+
+        Returns the cancelled forwards.
+        """
+        cancelled = []
+        kept = []
+        for forward in self.live():
+            if (node in (None, forward["node"])) and (
+                not ports or forward["port"] in ports or forward["local"] in ports
+            ):
+                self.ssh.cancel(forward["local"], forward["port"], forward["node"])
+                cancelled.append(forward)
+            else:
+                kept.append(forward)
+        self.state[self.ssh.host] = kept
+        self.save()
+        return cancelled
@@ -0,0 +1,82 @@
+"""Expansion and compression of Slurm hostlists, e.g. cn-a[001-004,010]."""
+
+import itertools
+import re
+from collections import defaultdict
+
+_top_level_comma = re.compile(r",(?![^\[]*\])")
+_bracket = re.compile(r"\[([^\]]*)\]")
+_last_number = re.compile(r"^(.*?)(\d+)(\D*)$")
+
+
+def expand(hostlist):
+    """Expand a hostlist into the list of host names, in order.
+
+    >>> expand("cn-a[001-003,010],cn-b1")
+    ['cn-a001', 'cn-a002', 'cn-a003', 'cn-a010', 'cn-b1']
+    """
+    hosts = []
+    for item in _top_level_comma.split(hostlist.strip()):
+        if not item:
+            continue
+        # Several bracket groups expand to their cartesian product
+        parts = _bracket.split(item)
+        choices = [
+            _expand_ranges(part) if i % 2 else [part] for i, part in enumerate(parts)
+        ]
+        hosts.extend("".join(combo) for combo in itertools.product(*choices))
+    return hosts
+
+
+def _expand_ranges(ranges):
+    results = []
+    for r in ranges.split(","):
+        start, _, end = r.partition("-")
+        if not end:
+            results.append(start)
+            continue
+        width = len(start)
+        results.extend(f"{i:0{width}d}" for i in range(int(start), int(end) + 1))
+    return results
+
+
+def compress(hosts):
+    """Compress host names into a hostlist, the inverse of expand.
+
+    Hosts are grouped by what surrounds their last number, and consecutive
+    numbers (with the same zero-padding) become ranges.
+
+    >>> compress(["cn-a001", "cn-a002", "cn-a003", "cn-a010", "login"])
+    'cn-a[001-003,010],login'
+    """
+    parsed = [(host, _last_number.match(host)) for host in hosts]
+    # Zero-padded numbers set the width of their group, e.g. 0998 and 1000
+    padded = {(m[1], m[3]): len(m[2]) for _, m in parsed if m and m[2].startswith("0")}
+    groups = defaultdict(set)
+    for host, m in parsed:
+        if m is None:
+            groups[host, "", None] = None
+            continue
+        prefix, number, suffix = m.groups()
+        width = padded.get((prefix, suffix), 0)
+        groups[prefix, suffix, width if len(number) == width else 0].add(int(number))
+    items = []
+    for (prefix, suffix, width), numbers in groups.items():
+        if numbers is None:
+            items.append(prefix)
+            continue
+        ranges = []
+        for number in sorted(numbers):
+            if ranges and number == ranges[-1][1] + 1:
+                ranges[-1][1] = number
+            else:
+                ranges.append([number, number])
+        text = ",".join(
+            f"{a:0{width}d}" if a == b else f"{a:0{width}d}-{b:0{width}d}"
+            for a, b in ranges
+        )
+        if len(ranges) == 1 and ranges[0][0] == ranges[0][1]:
+            items.append(f"{prefix}{text}{suffix}")
+        else:
+            items.append(f"{prefix}[{text}]{suffix}")
+    return ",".join(items)
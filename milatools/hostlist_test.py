@@ -0,0 +1,63 @@
+import pytest
+
+from milatools.hostlist import compress, expand
+
+
+@pytest.mark.parametrize(
+    "hostlist, hosts",
+    [
+        ("", []),
+        ("  ", []),
+        ("cn-a001", ["cn-a001"]),
+        ("cn-a[001]", ["cn-a001"]),
+        ("cn-a[001-003]", ["cn-a001", "cn-a002", "cn-a003"]),
+        (
+            "cn-a[001-003,010],cn-b1",
+            ["cn-a001", "cn-a002", "cn-a003", "cn-a010", "cn-b1"],
+        ),
+        # Commas inside brackets do not separate hosts, empty items are skipped
+        ("cn-a[1,3],,cn-b2", ["cn-a1", "cn-a3", "cn-b2"]),
+        # The zero-padding of the start of a range sets the width
+        ("a[098-101]", ["a098", "a099", "a100", "a101"]),
+        ("a[8-11]", ["a8", "a9", "a10", "a11"]),
+        # Text after the brackets
+        ("cn-a[1-2]-ib", ["cn-a1-ib", "cn-a2-ib"]),
+        # Several bracket groups give their cartesian product
+        ("cn-[1-2][01-02]", ["cn-101", "cn-102", "cn-201", "cn-202"]),
+    ],
+)
+def test_expand(hostlist, hosts):
+    assert expand(hostlist) == hosts
+
+
+@pytest.mark.parametrize(
+    "hosts, hostlist",
+    [
+        ([], ""),
+        (["login"], "login"),
+        (["cn-a001"], "cn-a001"),
+        (["cn-a001", "cn-a002", "cn-a003", "cn-a010"], "cn-a[001-003,010]"),
+        (["a1", "b1"], "a1,b1"),
+        (["a8", "a9", "a10", "a11"], "a[8-11]"),
+        (["a098", "a099", "a100"], "a[098-100]"),
+        (["a0998", "a0999", "a1000"], "a[0998-1000]"),
+        (["cn-a1-ib", "cn-a2-ib"], "cn-a[1-2]-ib"),
+        # Differently padded numbers are not the same host
+        (["a1", "a01"], "a1,a01"),
+        # Numbers are sorted within a group
+        (["a3", "a1", "a2"], "a[1-3]"),
+    ],
+)
+def test_compress(hosts, hostlist):
+    assert compress(hosts) == hostlist
+
+
+@pytest.mark.parametrize(
+    "hosts",
+    [
+        ["cn-a001", "cn-a002", "cn-a004", "cn-b010", "login-1"],
+        [f"cn-c{i:03d}" for i in range(1, 200, 3)],
+    ],
+)
+def test_roundtrip(hosts):
+    assert expand(compress(hosts)) == hosts
@@ -0,0 +1,153 @@
+import shlex
+import subprocess
+import time
+from collections import deque
+
+# Longest line read at once; longer lines are split
+max_line = 65536
+
+# Number of consecutive lines compared to find where the output resumes
+overlap = 20
+
+
+class LogStream:
+    """Lines of one or more remote files, multiplexed through a single tail.
+
+    tail prints a header (==> path <==) whenever it switches files, which
+    tells which file each line comes from. With follow=True, tail -F keeps
+    up with rotated or truncated files until the job leaves the queue.
+
+    Lines are read with a bounded size and only the last `scrollback` lines
+    are kept in `recent`, so memory stays constant however big the logs are.
+    If the connection drops while following, the stream reconnects with a
+    tail that starts from the last `scrollback` lines of each file, and uses
+    `recent` to skip the ones it already yielded.
+    """
+
+    def __init__(
+        self,
+        ssh,
+        paths,
+        lines=10,
+        follow=False,
+        jobid=None,
+        scrollback=1000,
+        retries=3,
+        retry_delay=5,
+    ):
+        self.ssh = ssh
+        self.paths = paths
+        self.lines = lines
+        self.follow = follow
+        self.jobid = jobid
+        self.recent = deque(maxlen=scrollback)
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.proc = None
+
+    def command(self, resume=False):
+        paths = " ".join(shlex.quote(path) for path in self.paths)
+        if not self.follow:
+            return f"tail -n {self.lines} {paths}"
+        lines = self.recent.maxlen if resume else self.lines
+        # Stop following once the job is gone, or if tail died
+        jobid = shlex.quote(self.jobid)
+        return (
+            f"tail -n {lines} -F {paths} & "
+            f'while kill -0 $! 2>/dev/null && [ -n "$(squeue -h -j {jobid} -o %T 2>/dev/null)" ]; '
+            "do sleep 10; done; sleep 1; kill $! 2>/dev/null"
+        )
+
+    def __iter__(self):
+        """Yield (path, line) tuples; path is None for our and tail's messages."""
+        resume = False
+        retries = self.retries
+        try:
+            while True:
+                for record in self._read(resume):
+                    retries = self.retries
+                    yield record
+                # ssh exits with 255 when the connection drops
+                if not self.follow or self.proc.wait() != 255 or not retries:
+                    return
+                retries -= 1
+                yield None, "Connection lost, reconnecting"
+                time.sleep(self.retry_delay)
+                resume = True
+        finally:
+            self.close()
+
+    def _read(self, resume):
+        self.proc = self.ssh.popen(
+            self.command(resume),
+            bash=True,
+            stderr=subprocess.STDOUT,
+            universal_newlines=False,
+        )
+        headers = {f"==> {path} <==": path for path in self.paths}
+        # Lines read again on resume, by path, until they catch up with recent
+        replay = {}
+        if resume:
+            for path in self.paths:
+                if seen := [line for p, line in self.recent if p == path]:
+                    replay[path] = (seen, [])
+        current = self.paths[0]
+        blank = False
+        while line := self.proc.stdout.readline(max_line):
+            line = line.decode(errors="replace").rstrip("\n")
+            if line in headers:
+                # tail separates files with a blank line before the header
+                if headers[line] != current:
+                    # tail printed all it read again of the previous file
+                    yield from self._resume(replay, current)
+                current, blank = headers[line], False
+                continue
+            if blank:
+                yield from self._emit(replay, current, "")
+            if blank := line == "" and len(self.paths) > 1:
+                continue
+            if line.startswith("tail: "):
+                yield None, line
+            else:
+                yield from self._emit(replay, current, line)
+        for path in list(replay):
+            yield from self._resume(replay, path)
+
+    def _emit(self, replay, path, line):
+        if path not in replay:
+            self.recent.append((path, line))
+            yield path, line
+            return
+        seen, lines = replay[path]
+        lines.append(line)
+        if line == seen[-1] and (start := _resume_index(seen, lines)) is not None:
+            del replay[path]
+            for line in lines[start:]:
+                yield from self._emit(replay, path, line)
+        elif len(lines) > self.recent.maxlen:
+            # More than tail reads again, so the lines of recent are gone
+            yield from self._resume(replay, path)
+
+    def _resume(self, replay, path):
+        """Yield the lines of path read again that did not catch up with recent."""
+        if path in replay:
+            _, lines = replay.pop(path)
+            yield None, f"Some lines of {path} may be missing"
+            for line in lines:
+                yield from self._emit(replay, path, line)
+
+    def close(self):
+        if self.proc is not None and self.proc.poll() is None:
+            self.proc.terminate()
+        self.proc = None
+
+
+def _resume_index(seen, lines):
+    """Index in lines just after the last lines of seen, None if not found."""
+    if not seen:
+        return 0
+    n = min(len(seen), overlap)
+    for end in range(len(lines), n - 1, -1):
+        if lines[end - n : end] == seen[-n:]:
+            return end
+    return None
@@ -0,0 +1,83 @@
+import io
+from collections import deque
+
+from milatools.logs import LogStream, _resume_index
+
+
+def test_resume_index():
+    assert _resume_index([], ["a"]) == 0
+    assert _resume_index(["a", "b"], ["x", "a", "b", "c"]) == 3
+    # The last occurrence counts
+    assert _resume_index(["b"], ["b", "c", "b", "d"]) == 3
+    assert _resume_index(["a", "b"], ["b", "c"]) is None
+
+
+class FakeProcess:
+    def __init__(self, output, returncode):
+        self.stdout = io.BytesIO(output.encode())
+        self.returncode = returncode
+
+    def wait(self):
+        return self.returncode
+
+    def poll(self):
+        return self.returncode
+
+
+class FakeConnection:
+    """Each popen replays the next output, as tail would print it."""
+
+    def __init__(self, *outputs):
+        self.outputs = list(outputs)
+        self.commands = []
+
+    def popen(self, command, **kwargs):
+        self.commands.append(command)
+        return FakeProcess(*self.outputs.pop(0))
+
+
+def read(ssh, paths):
+    stream = LogStream(ssh, paths, follow=True, jobid="1", retry_delay=0)
+    return list(stream)
+
+
+def test_resume_one_file():
+    ssh = FakeConnection(
+        ("1\n2\n3\n", 255),
+        # Read again from the start, with two new lines
+        ("1\n2\n3\n4\n5\n", 0),
+    )
+    lines = [line for _, line in read(ssh, ["out"])]
+    assert lines == ["1", "2", "3", "Connection lost, reconnecting", "4", "5"]
+    assert "tail -n 1000 -F" in ssh.commands[1]
+
+
+def test_resume_two_files():
+    ssh = FakeConnection(
+        ("==> out <==\no1\n\n==> err <==\ne1\n\n==> out <==\no2\n", 255),
+        (
+            "==> out <==\no1\no2\no3\n\n==> err <==\ne1\ne2\n" "\n==> out <==\no4\n",
+            0,
+        ),
+    )
+    records = [r for r in read(ssh, ["out", "err"]) if r[0] is not None]
+    assert records == [
+        ("out", "o1"),
+        ("err", "e1"),
+        ("out", "o2"),
+        ("out", "o3"),
+        ("err", "e2"),
+        ("out", "o4"),
+    ]
+
+
+def test_resume_missing_lines():
+    ssh = FakeConnection(("a\nb\n", 255), ("c\nd\n", 0))
+    stream = LogStream(ssh, ["out"], follow=True, jobid="1", retry_delay=0)
+    stream.recent = deque(maxlen=2)
+    records = list(stream)
+    assert records[-3:] == [
+        (None, "Some lines of out may be missing"),
+        ("out", "c"),
+        ("out", "d"),
+    ]
@@ -0,0 +1,109 @@
+import os
+import shlex
+import time
+
+from . import slurm
+from .utils import cachedir, read_json, write_json
+
+# Job name of the placeholder jobs in the pool
+pool_job_name = "mila-pool"
+
+pool_path = os.path.join(cachedir, "pool.json")
+
+
+class AllocationPool:
+    """Placeholder jobs submitted ahead of time, so that mila code gets a node
+    without waiting in the queue.
+
+    The pool's configuration and job ids are kept in ~/.cache/milatools/pool.json.
+    A job handed out by take() leaves the pool and runs until its time limit
+    or until it is cancelled.
+    """
+
+    def __init__(self, ssh, path=pool_path):
+        self.ssh = ssh
+        self.path = path
+        self.state = read_json(
+            path,
+            default={
+                "keep": 0,
+                "alloc": [],
+                "time_limit": "2:00:00",
+                "idle": 3600,
+                "jobs": [],
+                "last_used": time.time(),
+            },
+        )
+
+    def save(self):
+        write_json(self.path, self.state)
+
+    def configure(self, keep, alloc, time_limit, idle):
+        self.state.update(
+            keep=keep,
+            alloc=alloc,
+            time_limit=time_limit,
+            idle=idle,
+            last_used=time.time(),
+        )
+
+    def idle(self):
+        """Whether mila code did not use the pool for the idle period."""
+        return time.time() - self.state["last_used"] > self.state["idle"]
+
+    def live_jobs(self):
+        """Query Slurm once for the pool's jobs that still exist."""
+        if not self.state["jobs"]:
+            return []
+        output = self.ssh.get(slurm.squeue_command("-n", pool_job_name))
+        return [
+            job
+            for job in slurm.parse_squeue(output)
+            if job["jobid"] in self.state["jobs"]
+        ]
+
+    def refill(self):
+        """Submit or cancel jobs to bring the pool back to its size.
+
+        The pool is released if mila code did not use it for the idle period.
+        """
+        jobs = self.live_jobs()
+        if self.idle():
+            self.state["keep"] = 0
+        # Cancel pending jobs before running ones
+        jobs.sort(key=lambda job: job["state"] != "RUNNING")
+        keep = self.state["keep"]
+        if excess := [job["jobid"] for job in jobs[keep:]]:
+            self.ssh.get(shlex.join(["scancel", *excess]))
+        jobs = jobs[:keep]
+        if missing := keep - len(jobs):
+            command = slurm.placeholder_command(
+                [f"--time={self.state['time_limit']}", *self.state["alloc"]],
+                pool_job_name,
+            )
+            results = self.ssh.get_many([command] * missing)
+            for result in results:
+                if result.returncode != 0:
+                    print(result.stderr.strip())
+            submitted = [slurm.parse_sbatch(r.stdout) for r in results if r.stdout]
+            jobs += [{"jobid": jobid, "state": "SUBMITTED"} for jobid in submitted]
+        self.state["jobs"] = [job["jobid"] for job in jobs]
+        self.save()
+        return jobs
+
+    def take(self, candidates):
+        """Hand out a running job if the pool's options are among candidates.
+
+        Any job goes if no options were requested.
+        """
+        if any(candidates) and self.state["alloc"] not in candidates:
+            return None
+        jobs = self.live_jobs()
+        running = [job for job in jobs if job["state"] == "RUNNING"]
+        if not running:
+            return None
+        job = running[0]
+        self.state["jobs"] = [j["jobid"] for j in jobs if j is not job]
+        self.state["last_used"] = time.time()
+        self.save()
+        return job
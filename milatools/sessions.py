@@ -0,0 +1,65 @@
+import os
+import time
+
+from . import slurm
+from .utils import cachedir, read_json, write_json
+
+sessions_path = os.path.join(cachedir, "sessions.json")
+
+
+class Sessions:
+    """Registry of the sessions opened by mila code and mila serve.
+
+    Each session records its job, node, path, start time, control socket and
+    port forwards, in ~/.cache/milatools/sessions.json, so that a later
+    mila code can reattach to a job that is still running.
+    """
+
+    def __init__(self, path=sessions_path):
+        self.path = path
+        self.sessions = read_json(path, default=[])
+
+    def save(self):
+        write_json(self.path, self.sessions)
+
+    def find(self, kind, path):
+        """The most recent session of this kind for path, if any."""
+        for session in reversed(self.sessions):
+            if session["kind"] == kind and session["path"] == path:
+                return session
+        return None
+
+    def add(self, session):
+        """Record a session, replacing the previous one for the same path."""
+        self.sessions = [
+            s
+            for s in self.sessions
+            if s["job"] != session["job"]
+            and (s["kind"], s["path"]) != (session["kind"], session["path"])
+        ]
+        self.sessions.append({**session, "start": time.time()})
+        self.save()
+
+    def remove(self, sessions):
+        self.sessions = [s for s in self.sessions if s not in sessions]
+        self.save()
+
+    def refresh(self, ssh):
+        """Query Slurm once and forget the sessions whose job ended.
+
+        Returns the jobs of the remaining sessions, by job id.
+        """
+        if not self.sessions:
+            return {}
+        jobs = live_jobs(ssh, [s["job"] for s in self.sessions])
+        if ended := [s for s in self.sessions if s["job"] not in jobs]:
+            self.remove(ended)
+        return jobs
+
+
+def live_jobs(ssh, jobids):
+    """The jobs among jobids that are still in the queue, by job id."""
+    command = slurm.squeue_command("--jobs", ",".join(jobids))
+    # squeue fails when none of the jobs exists anymore
+    output = ssh.get(f"{command} 2>/dev/null || true")
+    return {job["jobid"]: job for job in slurm.parse_squeue(output)}
@@ -0,0 +1,361 @@
+import re
+import shlex
+import time
+
+# Fields of squeue's output, in the order they are requested
+squeue_fields = {
+    "jobid": "%i",
+    "name": "%j",
+    "state": "%T",
+    "nodes": "%N",
+    "partition": "%P",
+    "cpus": "%C",
+    "memory": "%m",
+    "gres": "%b",
+    "time_left": "%L",
+    "reason": "%r",
+}
+
+# Fields of sinfo's output, one line per node and partition
+sinfo_fields = [
+    "NodeHost",
+    "Partition",
+    "StateLong",
+    "CPUsState",
+    "Memory",
+    "AllocMem",
+    "Gres",
+    "GresUsed",
+]
+
+# Without a size, sinfo prints each field as is, followed by the suffix |
+sinfo_command = shlex.join(
+    ["sinfo", "-h", "-N", "-O", ",".join(f"{field}:|" for field in sinfo_fields)]
+)
+
+# salloc/sbatch options that we know how to compare to a running job
+alloc_options = {
+    "-p": "partition",
+    "--partition": "partition",
+    "-c": "cpus",
+    "--cpus-per-task": "cpus",
+    "--mem": "memory",
+    "--gres": "gres",
+    "-G": "gpus",
+    "--gpus": "gpus",
+    "-t": "time",
+    "--time": "time",
+}
+
+
+def squeue_command(*options):
+    """Command listing the user's jobs in the format parse_squeue expects."""
+    fmt = "|".join(squeue_fields.values())
+    return shlex.join(["squeue", "--me", "-h", "-o", fmt, *options])
+
+
+def placeholder_command(options, name):
+    """sbatch command for a job that just holds its allocation until cancelled."""
+    return shlex.join(
+        [
+            "sbatch",
+            "--parsable",
+            f"--job-name={name}",
+            "--output=/dev/null",
+            *options,
+            "--wrap=sleep infinity",
+        ]
+    )
+
+
+def parse_sbatch(output):
+    """Get the job id from the output of sbatch --parsable (jobid[;cluster])."""
+    return output.strip().split(";")[0]
+
+
+def parse_squeue(output):
+    jobs = []
+    for line in output.splitlines():
+        fields = line.strip().split("|")
+        # Skip anything that is not a job, e.g. a warning from squeue
+        if len(fields) == len(squeue_fields):
+            jobs.append(dict(zip(squeue_fields, fields)))
+    return jobs
+
+
+def parse_alloc_options(args):
+    """Parse the resources requested by salloc/sbatch options.
+
+    Returns None if the options include anything we cannot compare to the
+    resources of a running job.
+    """
+    request = {}
+    args = list(args)
+    while args:
+        arg = args.pop(0)
+        if arg.startswith("--") and "=" in arg:
+            opt, value = arg.split("=", 1)
+        elif arg in alloc_options and args:
+            opt, value = arg, args.pop(0)
+        elif arg[:2] in alloc_options and len(arg) > 2:
+            opt, value = arg[:2], arg[2:]
+        else:
+            return None
+        if opt not in alloc_options:
+            return None
+        request[alloc_options[opt]] = value
+
+    if "gres" in request:
+        request["gpus"] = parse_gpus(request.pop("gres"))
+    elif "gpus" in request:
+        request["gpus"] = parse_gpus(f"gpu:{request['gpus']}")
+    if "cpus" in request:
+        request["cpus"] = int(request["cpus"])
+    if "memory" in request:
+        request["memory"] = parse_memory(request["memory"])
+    if "time" in request:
+        request["time"] = parse_time(request["time"])
+    return request
+
+
+def remove_options(options, names):
+    """Remove the given options and their values from a list of options."""
+    options = list(options)
+    result = []
+    while options:
+        arg = options.pop(0)
+        if arg in names:
+            # --opt value or -o value
+            options = options[1:]
+        elif arg.startswith("--") and arg.split("=", 1)[0] in names:
+            # --opt=value
+            continue
+        elif not arg.startswith("--") and arg[:2] in names:
+            # -ovalue
+            continue
+        else:
+            result.append(arg)
+    return result
+
+
+def parse_gpus(gres):
+    """Return (type, count) for the GPUs in a GRES string, e.g. gpu:rtx8000:2.
+
+    type is None if the string does not name one, and count is 0 if there
+    are no GPUs at all.
+    """
+    # Commas inside parentheses are part of a GPU index list, e.g. (IDX:0,2)
+    for entry in re.split(r",(?![^(]*\))", gres):
+        entry = re.sub(r"^gres[:/]", "", entry)
+        entry = re.sub(r"\(.*\)$", "", entry)
+        parts = entry.split(":")
+        if parts[0] != "gpu":
+            continue
+        if len(parts) > 1 and parts[-1].isdigit():
+            count = int(parts.pop())
+        else:
+            count = 1
+        return (parts[1] if len(parts) > 1 else None), count
+    return None, 0
+
+
+def parse_memory(memory):
+    """Convert a Slurm memory amount (e.g. 16G, 4000M or 4000) to megabytes."""
+    m = re.fullmatch(r"([0-9.]+)([KMGT]?)B?", memory.upper())
+    if not m:
+        raise ValueError(f"Invalid memory amount: {memory}")
+    number, unit = m.groups()
+    scale = {"K": 1 / 1024, "M": 1, "": 1, "G": 1024, "T": 1024**2}[unit]
+    return int(float(number) * scale)
+
+
+def parse_time(time):
+    """Convert a Slurm time (e.g. 30, 1:30:00, 2-12:00) to seconds.
+
+    Returns None for UNLIMITED and other values that are not a time.
+    """
+    m = re.fullmatch(r"(?:([0-9]+)-)?([0-9]+)(?::([0-9]+))?(?::([0-9]+))?", time)
+    if not m:
+        return None
+    days, *rest = m.groups()
+    numbers = [int(x) for x in rest if x is not None]
+    if days is not None:
+        # days-hours[:minutes[:seconds]]
+        numbers += [0] * (3 - len(numbers))
+        hours, minutes, seconds = numbers
+    elif len(numbers) == 3:
+        hours, minutes, seconds = numbers
+    else:
+        # minutes[:seconds]
+        hours, (minutes, seconds) = 0, (numbers + [0])[:2]
+    return ((int(days or 0) * 24 + hours) * 60 + minutes) * 60 + seconds
+
+
+def job_matches(job, request):
+    """Whether a running job (from parse_squeue) satisfies a parsed request."""
+    if job["state"] != "RUNNING" or not re.fullmatch(r"[\w.-]+", job["nodes"]):
+        # Multi-node jobs are not considered
+        return False
+    partitions = request.get("partition")
+    if partitions and job["partition"] not in partitions.split(","):
+        return False
+    if int(job["cpus"]) < request.get("cpus", 1):
+        return False
+    if "memory" in request and parse_memory(job["memory"]) < request["memory"]:
+        return False
+    if "gpus" in request:
+        gpu_type, count = request["gpus"]
+        job_type, job_count = parse_gpus(job["gres"])
+        if job_count < count or (gpu_type and gpu_type != job_type):
+            return False
+    if "time" in request:
+        left = parse_time(job["time_left"])
+        if left is not None and left < request["time"]:
+            return False
+    return True
+
+
+class JobSnapshots:
+    """squeue --me snapshots shared by everything that waits on jobs.
+
+    A new snapshot is only taken when the last one is older than max_age
+    seconds, so any number of jobs can be polled for one squeue call.
+    """
+
+    def __init__(self, ssh, max_age=1.0):
+        self.ssh = ssh
+        self.max_age = max_age
+        self.time = None
+        self.jobs = {}
+
+    def get(self):
+        if self.time is None or time.monotonic() - self.time > self.max_age:
+            output = self.ssh.get(squeue_command())
+            self.jobs = {job["jobid"]: job for job in parse_squeue(output)}
+            self.time = time.monotonic()
+        return self.jobs
+
+
+def wait_running(snapshots, jobids, delay=0.5, max_delay=30, factor=1.5):
+    """Poll until one of the jobs is running, backing off exponentially.
+
+    Returns the first job found running, or None if all of them are gone.
+    """
+    reasons = {}
+    while True:
+        jobs = snapshots.get()
+        if not (alive := [jobs[jobid] for jobid in jobids if jobid in jobs]):
+            return None
+        for job in alive:
+            if job["state"] == "RUNNING":
+                return job
+            if reasons.get(job["jobid"]) != (reason := job["reason"]):
+                print(f"# Job {job['jobid']} is {job['state']} ({reason})")
+                reasons[job["jobid"]] = reason
+        time.sleep(delay)
+        delay = min(delay * factor, max_delay)
+
+
+# Fields whose changes mila jobs --watch reports
+watched_fields = ("state", "reason", "nodes")
+
+
+def diff_jobs(old, new):
+    """Changes between two snapshots {jobid: job}, as (jobid, before, after).
+
+    before is None for new jobs, and after is None for jobs that left the queue.
+    """
+    changes = []
+    for jobid, job in new.items():
+        before = old.get(jobid)
+        if before is None or any(before[f] != job[f] for f in watched_fields):
+            changes.append((jobid, before, job))
+    changes += [(jobid, job, None) for jobid, job in old.items() if jobid not in new]
+    return changes
+
+
+def parse_sacct(output):
+    """Map job ids to (state, exit code), from sacct -P -o JobID,State,ExitCode."""
+    final = {}
+    for line in output.splitlines():
+        fields = line.strip().split("|")
+        if len(fields) == 3:
+            jobid, state, exit_code = fields
+            # e.g. CANCELLED by 1234
+            final[jobid] = (state.split()[0], exit_code)
+    return final
+
+
+def watch_jobs(ssh, interval=2, max_interval=60, factor=1.5):
+    """Poll squeue and yield the changes of the user's jobs, as events.
+
+    The first poll yields a "new" event for every job. The polls are fast
+    while jobs change and slow down exponentially while nothing happens.
+    The jobs that leave the queue are looked up with one sacct call per poll,
+    for their final state and exit code.
+    """
+    jobs = {}
+    delay = interval
+    while True:
+        output = ssh.get(squeue_command(), quiet=True)
+        # The pending tasks of an array, e.g. 123_[4-9], shrink as tasks start,
+        # so they are keyed without their indices
+        snapshot = {
+            re.sub(r"\[.*", "[]", job["jobid"]): job for job in parse_squeue(output)
+        }
+        changes = [
+            (jobid, before, after)
+            for jobid, before, after in diff_jobs(jobs, snapshot)
+            if after is not None or "[" not in jobid
+        ]
+        final = {}
+        if ended := [jobid for jobid, _, after in changes if after is None]:
+            command = ["sacct", "-X", "-n", "-P", "-o", "JobID,State,ExitCode"]
+            output = ssh.get(shlex.join([*command, "-j", ",".join(ended)]), quiet=True)
+            final = parse_sacct(output)
+        for jobid, before, after in changes:
+            yield _job_event(before, after, final)
+        jobs = snapshot
+        delay = interval if changes else min(delay * factor, max_interval)
+        time.sleep(delay)
+
+
+def _job_event(before, after, final):
+    job = after or before
+    jobid = job["jobid"]
+    event = {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "event": "new" if before is None else "ended" if after is None else "changed",
+        "jobid": jobid,
+        "name": job["name"],
+        "state": job["state"],
+        "reason": job["reason"],
+        "nodes": job["nodes"],
+    }
+    if before is not None:
+        event["previous"] = {f: before[f] for f in watched_fields}
+    if after is None:
+        event["state"], event["exit_code"] = final.get(jobid, ("UNKNOWN", None))
+    return event
+
+
+def parse_scontrol(output):
+    """Fields of the first record of scontrol show job, as a dict.
+
+    Paths (e.g. StdOut=...) take the rest of their line, since they may
+    contain spaces.
+    """
+    fields = {}
+    for line in output.splitlines():
+        if not line.strip():
+            if fields:
+                break
+            continue
+        key, _, value = line.strip().partition("=")
+        if key in ("Command", "WorkDir", "StdIn", "StdOut", "StdErr"):
+            fields.setdefault(key, value)
+            continue
+        for token in line.split():
+            key, _, value = token.partition("=")
+            fields.setdefault(key, value)
+    return fields
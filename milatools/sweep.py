@@ -0,0 +1,220 @@
+import csv
+import itertools
+import json
+import os
+import re
+import shlex
+import time
+from collections import Counter
+
+from . import hostlist, slurm
+from .utils import cachedir, read_json, write_json
+
+sweeps_dir = os.path.join(cachedir, "sweeps")
+
+# Final states of array tasks that are worth running again
+failed_states = {
+    "BOOT_FAIL",
+    "FAILED",
+    "NODE_FAIL",
+    "OUT_OF_MEMORY",
+    "PREEMPTED",
+    "TIMEOUT",
+}
+
+# State of the points whose array could not be submitted
+unsubmitted_state = "UNSUBMITTED"
+
+
+def load_spec(path):
+    """Load the parameter sets of a sweep from a YAML, JSON or CSV file.
+
+    YAML and JSON files contain either a list of parameter sets, or a mapping
+    from parameter names to lists of values, which is expanded to the grid of
+    all their combinations. Each row of a CSV file is a parameter set.
+    """
+    ext = os.path.splitext(path)[1].lower()
+    with open(path) as f:
+        if ext == ".csv":
+            return list(csv.DictReader(f))
+        elif ext in (".yaml", ".yml"):
+            try:
+                import yaml
+            except ImportError:
+                exit("ERROR: YAML sweep files require pyyaml (pip install pyyaml)")
+            spec = yaml.safe_load(f)
+        elif ext == ".json":
+            spec = json.load(f)
+        else:
+            exit(f"ERROR: Unknown sweep file format '{ext}' (use yaml, json or csv)")
+    if isinstance(spec, dict):
+        values = [v if isinstance(v, list) else [v] for v in spec.values()]
+        return [dict(zip(spec, combo)) for combo in itertools.product(*values)]
+    return spec
+
+
+def command_line(command, params):
+    """Shell command line giving params to command as --name=value options."""
+    options = [f"--{name}={value}" for name, value in params.items()]
+    return shlex.join([*command, *options])
+
+
+def array_spec(indices, throttle=None):
+    """Value of sbatch --array for the given task indices, e.g. 0-9,12%4."""
+    ranges = []
+    for _, group in itertools.groupby(enumerate(indices), lambda x: x[1] - x[0]):
+        group = [index for _, index in group]
+        first, last = group[0], group[-1]
+        ranges.append(str(first) if first == last else f"{first}-{last}")
+    spec = ",".join(ranges)
+    return f"{spec}%{throttle}" if throttle else spec
+
+
+def parse_sacct(output):
+    """Map (jobid, task index) to the state of array tasks in sacct -P output.
+
+    Tasks that did not start yet are listed in ranges, e.g. 123_[4-9%2].
+    """
+    tasks = {}
+    for line in output.splitlines():
+        m = re.fullmatch(r"(\d+)_(\d+|\[[^\]]*\])\|(\w+).*", line.strip())
+        if not m:
+            continue
+        jobid, indices, state = m.groups()
+        if indices.startswith("["):
+            indices = hostlist.expand(re.sub(r"%\d+", "", indices))
+        else:
+            indices = [indices]
+        for index in indices:
+            tasks[jobid, int(index)] = state
+    return tasks
+
+
+class Sweep:
+    """A sweep submitted by mila run, as job arrays over a parameter file.
+
+    Line i + 1 of the remote parameter file is the command line of sweep
+    point i. Each array covers a chunk of consecutive points: task t of the
+    array at offset o runs point o + t. The arrays' job ids, and the points
+    whose array sbatch refused, are kept in ~/.cache/milatools/sweeps/NAME.json
+    so that failed points can be submitted again.
+    """
+
+    def __init__(self, ssh, name):
+        self.ssh = ssh
+        self.name = name
+        self.path = os.path.join(sweeps_dir, f"{name}.json")
+        self.state = read_json(self.path, default=None)
+
+    def save(self):
+        write_json(self.path, self.state)
+
+    def create(self, points, command, options, throttle, chunk, home):
+        """Write the parameter file and submit one array per chunk of points."""
+        self.state = {
+            "dir": f"{home}/.cache/milatools/sweeps/{self.name}",
+            "size": len(points),
+            "options": options,
+            "throttle": throttle,
+            "chunk": chunk,
+            "arrays": [],
+            "unsubmitted": [],
+        }
+        lines = "".join(f"{command_line(command, params)}\n" for params in points)
+        self.ssh.put(lines, f"{self.state['dir']}/params")
+        self.submit(
+            [
+                (offset, range(min(chunk, len(points) - offset)))
+                for offset in range(0, len(points), chunk)
+            ]
+        )
+
+    def array_command(self, offset, indices):
+        params = shlex.quote(f"{self.state['dir']}/params")
+        # Run the line of the parameter file for this task's point
+        wrap = (
+            f"i=$(({offset} + SLURM_ARRAY_TASK_ID)); export MILA_SWEEP_INDEX=$i; "
+            f'eval "exec $(sed -n "$((i + 1))p" {params})"'
+        )
+        return shlex.join(
+            [
+                "sbatch",
+                "--parsable",
+                f"--job-name={self.name}",
+                f"--array={array_spec(indices, self.state['throttle'])}",
+                f"--output={self.state['dir']}/%A_%a.out",
+                *self.state["options"],
+                f"--wrap={wrap}",
+            ]
+        )
+
+    def submit(self, arrays):
+        """Submit arrays, given as (offset, task indices), in one round trip."""
+        start = time.monotonic()
+        results = self.ssh.get_many(
+            [self.array_command(offset, indices) for offset, indices in arrays]
+        )
+        elapsed = time.monotonic() - start
+        tasks = 0
+        unsubmitted = set(self.state.get("unsubmitted", []))
+        for (offset, indices), result in zip(arrays, results):
+            points = {offset + index for index in indices}
+            if result.returncode != 0:
+                print(result.stderr.strip())
+                unsubmitted |= points
+                continue
+            jobid = slurm.parse_sbatch(result.stdout)
+            self.state["arrays"].append({"jobid": jobid, "offset": offset})
+            unsubmitted -= points
+            tasks += len(indices)
+        self.state["unsubmitted"] = sorted(unsubmitted)
+        self.save()
+        print(
+            f"# Submitted {tasks} tasks in {len(arrays)} arrays in {elapsed:.2f}s"
+            f" ({tasks / max(elapsed, 1e-6):.0f} tasks/s)"
+        )
+        if unsubmitted:
+            print(f"# {len(unsubmitted)} tasks were not submitted, use --resubmit")
+        return tasks
+
+    def states(self):
+        """Query sacct once for the state of the latest attempt of each point.
+
+        The points whose array could not be submitted are UNSUBMITTED.
+        """
+        states = dict.fromkeys(self.state.get("unsubmitted", []), unsubmitted_state)
+        arrays = self.state["arrays"]
+        if not arrays:
+            return states
+        jobids = ",".join(array["jobid"] for array in arrays)
+        output = self.ssh.get(
+            shlex.join(["sacct", "-X", "-n", "-P", "-o", "JobID,State", "-j", jobids])
+        )
+        offsets = {array["jobid"]: array["offset"] for array in arrays}
+        order = {jobid: i for i, jobid in enumerate(offsets)}
+        # Later arrays are resubmissions, so their states take precedence
+        for (jobid, task), state in sorted(
+            parse_sacct(output).items(), key=lambda item: order[item[0][0]]
+        ):
+            states[offsets[jobid] + task] = state
+        return states
+
+    def resubmit(self):
+        """Submit the points whose latest attempt failed again."""
+        states = self.states()
+        counts = Counter(states.values())
+        print("#", ", ".join(f"{n} {state}" for state, n in sorted(counts.items())))
+        retry = failed_states | {unsubmitted_state}
+        failed = sorted(i for i, state in states.items() if state in retry)
+        if not failed:
+            print("# No failed tasks to submit again")
+            return 0
+        chunk = self.state["chunk"]
+        return self.submit(
+            [
+                (offset, [i - offset for i in group])
+                for offset, group in itertools.groupby(
+                    failed, lambda i: i // chunk * chunk
+                )
+            ]
+        )
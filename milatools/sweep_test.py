@@ -0,0 +1,81 @@
+import subprocess
+
+from milatools import sweep
+from milatools.sweep import Sweep, array_spec, parse_sacct
+
+
+def test_array_spec():
+    assert array_spec([0, 1, 2, 5, 7, 8], None) == "0-2,5,7-8"
+    assert array_spec([3], 4) == "3%4"
+
+
+def test_parse_sacct():
+    output = "10_0|COMPLETED\n10_1|FAILED\n10_[2-4%2]|PENDING\n11|RUNNING\n"
+    assert parse_sacct(output) == {
+        ("10", 0): "COMPLETED",
+        ("10", 1): "FAILED",
+        ("10", 2): "PENDING",
+        ("10", 3): "PENDING",
+        ("10", 4): "PENDING",
+    }
+
+
+class FakeConnection:
+    """Sweep's view of the cluster: sbatch and sacct."""
+
+    def __init__(self):
+        self.jobid = 100
+        self.refuse = False
+        self.sacct = ""
+        self.commands = []
+
+    def put(self, data, path):
+        pass
+
+    def get_many(self, commands):
+        results = []
+        for command in commands:
+            if self.refuse:
+                results.append(subprocess.CompletedProcess(command, 1, "", "refused"))
+            else:
+                self.jobid += 1
+                results.append(
+                    subprocess.CompletedProcess(command, 0, f"{self.jobid}\n", "")
+                )
+        return results
+
+    def get(self, command):
+        self.commands.append(command)
+        return self.sacct
+
+
+def test_resubmit_unsubmitted(tmp_path, monkeypatch):
+    monkeypatch.setattr(sweep, "sweeps_dir", str(tmp_path))
+    ssh = FakeConnection()
+    ssh.refuse = True
+    points = [{"lr": lr} for lr in range(5)]
+    s = Sweep(ssh, "test")
+    s.create(points, ["python", "train.py"], [], None, 2, "/home/me")
+    assert s.state["unsubmitted"] == [0, 1, 2, 3, 4]
+    # No array to ask sacct about
+    assert s.states() == dict.fromkeys(range(5), "UNSUBMITTED")
+    assert ssh.commands == []
+
+    ssh.refuse = False
+    assert Sweep(ssh, "test").resubmit() == 5
+    s = Sweep(ssh, "test")
+    assert s.state["unsubmitted"] == []
+    assert [a["offset"] for a in s.state["arrays"]] == [0, 2, 4]
+
+
+def test_resubmit_failed(tmp_path, monkeypatch):
+    monkeypatch.setattr(sweep, "sweeps_dir", str(tmp_path))
+    ssh = FakeConnection()
+    s = Sweep(ssh, "test")
+    s.create([{"x": x} for x in range(4)], ["run"], [], None, 2, "/home/me")
+    ssh.sacct = "101_0|COMPLETED\n101_1|TIMEOUT\n102_0|COMPLETED\n102_1|FAILED\n"
+    assert s.states() == {0: "COMPLETED", 1: "TIMEOUT", 2: "COMPLETED", 3: "FAILED"}
+    assert s.resubmit() == 2
+    # The resubmissions take precedence
+    ssh.sacct += "103_1|COMPLETED\n104_1|RUNNING\n"
+    assert s.states() == {0: "COMPLETED", 1: "COMPLETED", 2: "COMPLETED", 3: "RUNNING"}
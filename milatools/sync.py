@@ -0,0 +1,176 @@
+import fnmatch
+import hashlib
+import os
+import shlex
+import stat
+import subprocess
+import tarfile
+import time
+
+from .utils import T, cachedir, read_json, write_json
+
+manifests_dir = os.path.join(cachedir, "sync")
+
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(1 << 20):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def excluded(rel, patterns):
+    parts = rel.split("/")
+    return any(
+        fnmatch.fnmatch(rel, p) or any(fnmatch.fnmatch(part, p) for part in parts)
+        for p in patterns
+    )
+
+
+def scan(root, previous=None, exclude=()):
+    """Manifest of the files under root: {relative path: [size, mtime_ns, sha256]}.
+
+    Files whose size and mtime are the same as in the previous manifest are
+    not hashed again.
+    """
+    previous = previous or {}
+    files = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        base = os.path.relpath(dirpath, root).replace(os.sep, "/")
+        base = "" if base == "." else f"{base}/"
+        dirnames[:] = [d for d in dirnames if not excluded(base + d, exclude)]
+        for name in filenames:
+            rel = base + name
+            path = os.path.join(dirpath, name)
+            st = os.lstat(path)
+            if not stat.S_ISREG(st.st_mode) or excluded(rel, exclude):
+                continue
+            entry = previous.get(rel)
+            if entry and entry[:2] == [st.st_size, st.st_mtime_ns]:
+                digest = entry[2]
+            else:
+                digest = file_hash(path)
+            files[rel] = [st.st_size, st.st_mtime_ns, digest]
+    return files
+
+
+def remote_manifest(ssh, remote):
+    """Manifest of the files under remote: {relative path: (size, mtime)}.
+
+    Takes a single round trip; the remote files are not hashed.
+    """
+    output = ssh.get(
+        f"cd {remote} 2>/dev/null && find . -type f -printf '%s %T@ %P\\0' || true"
+    )
+    files = {}
+    for record in output.split("\0"):
+        if record:
+            size, mtime, rel = record.split(" ", 2)
+            files[rel] = (int(size), float(mtime))
+    return files
+
+
+def changes(local, synced, remote, exclude=()):
+    """Files to send and remote files to delete to make remote match local.
+
+    A file is sent if it changed locally since the last sync (its hash), or
+    if it is missing or was modified on the remote side (its size or mtime
+    no longer match the last sync).
+    """
+    send = []
+    for rel, (size, _, digest) in local.items():
+        old = synced.get(rel)
+        there = remote.get(rel)
+        if (
+            old is None
+            or there is None
+            or old[2] != digest
+            or there[0] != size
+            # tar may round mtimes to the second
+            or abs(there[1] - old[3]) >= 1
+        ):
+            send.append(rel)
+    delete = [rel for rel in remote if rel not in local and not excluded(rel, exclude)]
+    return send, delete
+
+
+def remote_path(path):
+    """Remote path to quote in commands.
+
+    Paths under ~/ are made relative, since ~ is not expanded once quoted and
+    the remote shell starts in $HOME.
+    """
+    if path == "~" or path.startswith("~/"):
+        path = path[2:]
+    return path or "."
+
+
+def send_files(ssh, root, remote, paths, delete=()):
+    """Stream the files as a single tar to remote, deleting others first."""
+    command = f"mkdir -p {remote} && cd {remote}"
+    if delete:
+        command += f" && rm -f -- {shlex.join(delete)}"
+    proc = ssh.popen(
+        f"{command} && tar -xf -",
+        stdin=subprocess.PIPE,
+        stdout=None,
+        universal_newlines=False,
+    )
+    try:
+        with tarfile.open(fileobj=proc.stdin, mode="w|") as tar:
+            for rel in paths:
+                tar.add(os.path.join(root, rel), arcname=rel, recursive=False)
+    finally:
+        proc.stdin.close()
+        if proc.wait() != 0:
+            raise subprocess.CalledProcessError(proc.returncode, proc.args)
+
+
+class Sync:
+    """Incremental copy of a local directory to a remote one.
+
+    The manifest of the last synced state (size, mtime, hash and remote mtime
+    of each file) is kept in ~/.cache/milatools/sync/, so that only the files
+    that changed since are hashed and sent.
+    """
+
+    def __init__(self, ssh, local, remote, exclude=()):
+        self.ssh = ssh
+        self.local = os.path.abspath(local)
+        self.remote = remote
+        self.exclude = exclude
+        key = hashlib.sha256(f"{ssh.host}:{self.local}:{remote}".encode())
+        self.path = os.path.join(manifests_dir, f"{key.hexdigest()[:16]}.json")
+        self.synced = read_json(self.path, default={}).get("files", {})
+
+    def run(self, delete=False, dry_run=False):
+        start = time.monotonic()
+        local = scan(self.local, self.synced, self.exclude)
+        remote = shlex.quote(remote_path(self.remote))
+        there = remote_manifest(self.ssh, remote)
+        send, extra = changes(local, self.synced, there, self.exclude)
+        extra = extra if delete else []
+        if dry_run:
+            for rel in send:
+                print(f"send {rel}")
+            for rel in extra:
+                print(f"delete {rel}")
+            return send, extra
+        if send or extra:
+            send_files(self.ssh, self.local, remote, send, extra)
+        # Also record the remote mtimes, which tar sets to the local ones
+        sent = set(send)
+        for rel, entry in local.items():
+            entry.append(entry[1] / 1e9 if rel in sent else there[rel][1])
+        write_json(
+            self.path, {"local": self.local, "remote": self.remote, "files": local}
+        )
+        size = sum(local[rel][0] for rel in send)
+        print(
+            T.bold(
+                f"# Sent {len(send)} files ({size / 1e6:.1f} MB), deleted {len(extra)},"
+                f" {len(local) - len(send)} unchanged, in {time.monotonic() - start:.2f}s"
+            )
+        )
+        return send, extra
@@ -0,0 +1,101 @@
+import json
+import subprocess
+import threading
+import time
+from contextlib import contextmanager
+
+
+class Tracer:
+    """Record the wall time, exit code and output size of every command.
+
+    Each event has a phase: "local" for local commands, "master" for control
+    socket probes, "auth" for master startup (ssh -f returns once we are
+    authenticated), "remote" for remote commands and "wait" for the time
+    spent waiting on a pattern in extract (e.g. for salloc to give us a node).
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.origin = time.perf_counter()
+        self.events = []
+        self.lock = threading.Lock()
+
+    def now(self):
+        return time.perf_counter() - self.origin
+
+    def record(self, event):
+        if self.enabled:
+            with self.lock:
+                self.events.append(event)
+
+    @contextmanager
+    def span(self, phase, host, args):
+        event = {
+            "phase": phase,
+            "host": host,
+            "command": " ".join(args),
+            "start": self.now(),
+            "returncode": None,
+            "bytes": 0,
+        }
+        try:
+            yield event
+            if event["returncode"] is None:
+                event["returncode"] = 0
+        except subprocess.CalledProcessError as err:
+            event["returncode"] = err.returncode
+            raise
+        finally:
+            event["duration"] = self.now() - event["start"]
+            self.record(event)
+
+    def watch(self, proc, phase, host, args):
+        """Record the lifetime of proc once it ends, from a background thread."""
+        if not self.enabled:
+            return
+
+        def wait():
+            with self.span(phase, host, args) as event:
+                event["returncode"] = proc.wait()
+
+        threading.Thread(target=wait, daemon=True).start()
+
+    def report(self):
+        print("# Timeline (start, duration, phase, host, exit code, bytes, command)")
+        for e in sorted(self.events, key=lambda e: e["start"]):
+            print(
+                f"{e['start']:9.3f}s {e['duration']:9.3f}s  {e['phase']:<6}"
+                f" {e['host']:<12} {str(e['returncode']):>4} {e['bytes']:>9}"
+                f"  {e['command']}"
+            )
+
+    def dump(self, path):
+        """Write the events in Chrome's trace format (chrome://tracing, Perfetto)."""
+        trace = []
+        lanes = {}
+        for e in sorted(self.events, key=lambda e: e["start"]):
+            # Overlapping events on a host go to separate lanes so they display
+            ends = lanes.setdefault(e["host"], [])
+            lane = next((i for i, end in enumerate(ends) if end <= e["start"]), None)
+            if lane is None:
+                lane = len(ends)
+                ends.append(0)
+            ends[lane] = e["start"] + e["duration"]
+            tid = f"{e['host']} #{lane}"
+            trace.append(
+                {
+                    "name": e["command"],
+                    "cat": e["phase"],
+                    "ph": "X",
+                    "ts": e["start"] * 1e6,
+                    "dur": e["duration"] * 1e6,
+                    "pid": 0,
+                    "tid": tid,
+                    "args": {"returncode": e["returncode"], "bytes": e["bytes"]},
+                }
+            )
+        with open(path, "w") as f:
+            json.dump({"traceEvents": trace, "displayTimeUnit": "ms"}, f, indent=1)
+
+
+tracer = Tracer()
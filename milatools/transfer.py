@@ -0,0 +1,299 @@
+import hashlib
+import os
+import queue
+import shlex
+import stat
+import subprocess
+import tarfile
+import threading
+import time
+
+from .sync import remote_manifest, remote_path
+from .utils import T, cachedir, read_json, write_json
+
+checkpoints_dir = os.path.join(cachedir, "transfers")
+
+MB = 1 << 20
+
+
+def list_files(root):
+    """{relative path: (size, mtime_ns)} of the regular files under root.
+
+    If root is a file, it is the only one, under its own name.
+    """
+    if not os.path.isdir(root):
+        st = os.stat(root)
+        return {os.path.basename(root): (st.st_size, st.st_mtime_ns)}
+    files = {}
+    for dirpath, _, filenames in os.walk(root):
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            st = os.lstat(path)
+            if stat.S_ISREG(st.st_mode):
+                rel = os.path.relpath(path, root).replace(os.sep, "/")
+                files[rel] = (st.st_size, st.st_mtime_ns)
+    return files
+
+
+def plan(files, chunk_size, batch_size):
+    """Split the files into parts that can be sent independently.
+
+    Files larger than chunk_size are split into byte ranges, which are written
+    in place on the remote side. Smaller files are packed together in tar
+    batches of about batch_size bytes. Each part gets an id that does not
+    change as long as its files do not, for the checkpoints.
+    """
+    parts = []
+    batch = []
+    batch_bytes = 0
+    for rel, (size, mtime_ns) in sorted(files.items()):
+        if size > chunk_size:
+            for offset in range(0, size, chunk_size):
+                length = min(chunk_size, size - offset)
+                key = f"{rel}:{size}:{mtime_ns}:{offset}"
+                parts.append(_part("range", [rel], length, key, offset=offset))
+            continue
+        batch.append(rel)
+        batch_bytes += size
+        if batch_bytes >= batch_size:
+            parts.append(_batch(batch, batch_bytes, files))
+            batch, batch_bytes = [], 0
+    if batch:
+        parts.append(_batch(batch, batch_bytes, files))
+    return parts
+
+
+def _batch(batch, nbytes, files):
+    key = "\n".join(f"{rel}:{files[rel][0]}:{files[rel][1]}" for rel in batch)
+    return _part("tar", batch, nbytes, key)
+
+
+def _part(kind, files, nbytes, key, offset=0):
+    digest = hashlib.sha256(key.encode()).hexdigest()[:16]
+    return {
+        "id": digest,
+        "kind": kind,
+        "files": files,
+        "bytes": nbytes,
+        "offset": offset,
+    }
+
+
+class _CountingWriter:
+    def __init__(self, stream, count):
+        self.stream = stream
+        self.count = count
+
+    def write(self, data):
+        self.stream.write(data)
+        self.count(len(data))
+        return len(data)
+
+
+class Transfer:
+    """Copy of a file or directory to a remote directory over parallel streams.
+
+    The parts of the transfer (see plan) are sent by several threads, each
+    through its own session on the shared control master. The number of
+    streams is tuned while the transfer runs: a stream is added for as long
+    as it increases the throughput, and removed when the throughput drops.
+
+    Completed parts are recorded in a checkpoint in
+    ~/.cache/milatools/transfers/, so that an interrupted transfer resumes
+    where it stopped. Files that already exist remotely with the same size
+    and mtime are skipped.
+    """
+
+    def __init__(
+        self,
+        ssh,
+        local,
+        remote,
+        channels=4,
+        max_channels=8,
+        chunk_size=256 * MB,
+        batch_size=64 * MB,
+        period=5,
+    ):
+        self.ssh = ssh
+        self.local = os.path.abspath(local)
+        self.remote = remote_path(remote)
+        self.channels = channels
+        self.max_channels = max_channels
+        self.chunk_size = chunk_size
+        self.batch_size = batch_size
+        self.period = period
+        key = hashlib.sha256(f"{ssh.host}:{self.local}:{self.remote}".encode())
+        self.path = os.path.join(checkpoints_dir, f"{key.hexdigest()[:16]}.json")
+        self.done = set(read_json(self.path, default=[]))
+        self.lock = threading.Lock()
+        self.errors = []
+        self.sent = 0
+        self.saved = time.monotonic()
+
+    def source(self, rel):
+        if os.path.isdir(self.local):
+            return os.path.join(self.local, rel)
+        return self.local
+
+    def command(self, part):
+        remote = shlex.quote(self.remote)
+        if part["kind"] == "tar":
+            return f"mkdir -p {remote} && tar -xf - -C {remote}"
+        (rel,) = part["files"]
+        path = shlex.quote(f"{self.remote}/{rel}")
+        size = os.path.getsize(self.source(rel))
+        return (
+            f"mkdir -p $(dirname {path}) && truncate -s {size} {path}"
+            f" && dd of={path} bs=1M seek={part['offset']} oflag=seek_bytes"
+            " conv=notrunc status=none"
+        )
+
+    def send(self, part):
+        proc = self.ssh.popen(
+            self.command(part),
+            quiet=True,
+            stdin=subprocess.PIPE,
+            stdout=None,
+            universal_newlines=False,
+        )
+        out = _CountingWriter(proc.stdin, self.count)
+        try:
+            if part["kind"] == "tar":
+                with tarfile.open(fileobj=out, mode="w|") as tar:
+                    for rel in part["files"]:
+                        tar.add(self.source(rel), arcname=rel, recursive=False)
+            else:
+                with open(self.source(part["files"][0]), "rb") as f:
+                    f.seek(part["offset"])
+                    remaining = part["bytes"]
+                    while remaining and (chunk := f.read(min(MB, remaining))):
+                        out.write(chunk)
+                        remaining -= len(chunk)
+        finally:
+            proc.stdin.close()
+            if proc.wait() != 0:
+                raise subprocess.CalledProcessError(proc.returncode, proc.args)
+
+    def count(self, nbytes):
+        with self.lock:
+            self.sent += nbytes
+
+    def save(self):
+        with self.lock:
+            done = list(self.done)
+            self.saved = time.monotonic()
+        write_json(self.path, done)
+
+    def worker(self):
+        while True:
+            with self.lock:
+                if self.running > self.target or self.stopped:
+                    self.running -= 1
+                    return
+                try:
+                    part = self.queue.get_nowait()
+                except queue.Empty:
+                    self.running -= 1
+                    return
+            try:
+                self.send(part)
+            except (OSError, subprocess.CalledProcessError) as err:
+                with self.lock:
+                    self.errors.append((part, err))
+                continue
+            with self.lock:
+                self.done.add(part["id"])
+            if time.monotonic() - self.saved > 1:
+                self.save()
+
+    def start_worker(self):
+        with self.lock:
+            self.running += 1
+        threading.Thread(target=self.worker, daemon=True).start()
+
+    def tune(self, rate, best):
+        """Hill climbing on the number of streams. Returns the new best rate."""
+        if rate > best * 1.1:
+            if self.target < self.max_channels and not self.queue.empty():
+                self.target += 1
+                self.start_worker()
+            return rate
+        if rate < best * 0.8 and self.target > 1:
+            # Try again from fewer streams
+            self.target -= 1
+            return rate
+        return best
+
+    def run(self):
+        files = list_files(self.local)
+        there = remote_manifest(self.ssh, shlex.quote(self.remote))
+        files = {
+            rel: (size, mtime_ns)
+            for rel, (size, mtime_ns) in files.items()
+            if rel not in there
+            or there[rel][0] != size
+            or abs(there[rel][1] - mtime_ns / 1e9) >= 1
+        }
+        parts = plan(files, self.chunk_size, self.batch_size)
+        todo = [part for part in parts if part["id"] not in self.done]
+        total = sum(part["bytes"] for part in todo)
+        print(
+            f"# {len(files)} files to send ({total / 1e9:.2f} GB in {len(todo)} parts,"
+            f" {len(parts) - len(todo)} already sent)"
+        )
+
+        self.queue = queue.Queue()
+        for part in todo:
+            self.queue.put(part)
+        self.target = self.channels
+        self.running = 0
+        self.stopped = False
+        start = last = time.monotonic()
+        sent = best = 0
+        for _ in range(self.target):
+            self.start_worker()
+        try:
+            while self.running:
+                time.sleep(min(self.period, 0.1))
+                if (now := time.monotonic()) - last < self.period:
+                    continue
+                rate = (self.sent - sent) / (now - last)
+                sent, last = self.sent, now
+                best = self.tune(rate, best)
+                print(
+                    f"# {self.sent / 1e9:.2f}/{total / 1e9:.2f} GB,"
+                    f" {rate / 1e6:.1f} MB/s over {self.target} streams"
+                )
+        except KeyboardInterrupt:
+            self.stopped = True
+            self.save()
+            exit("Interrupted, run the same command again to resume")
+        self.save()
+
+        elapsed = time.monotonic() - start
+        print(
+            T.bold(
+                f"# Sent {self.sent / 1e9:.2f} GB in {elapsed:.1f}s"
+                f" ({self.sent / 1e6 / elapsed:.1f} MB/s)"
+            )
+        )
+        for part, err in self.errors:
+            print(T.bold_red(f"# Failed to send {', '.join(part['files'][:3])}: {err}"))
+        if self.errors:
+            exit("ERROR: Some parts failed, run the same command again to retry them")
+        self.finish(files, parts)
+
+    def finish(self, files, parts):
+        """Give the split files their local mtime, and forget the checkpoint."""
+        split = sorted({p["files"][0] for p in parts if p["kind"] == "range"})
+        if split:
+            self.ssh.get_many(
+                [
+                    f"touch -d @{files[rel][1] / 1e9:.6f} "
+                    + shlex.quote(f"{self.remote}/{rel}")
+                    for rel in split
+                ]
+            )
+        if os.path.exists(self.path):
+            os.remove(self.path)
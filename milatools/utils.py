@@ -1,44 +1,77 @@
+import asyncio
+import atexit
+import functools
+import io
+import itertools
+import json
 import os
 import re
+import selectors
 import shlex
+import socket
 import subprocess
+import sys
+import tempfile
+import threading
+import time
 
 import blessed
 from sshconf import read_ssh_config
 
+from .trace import tracer
+
 sockdir = os.path.expanduser("~/.ssh/sockets")
+cachedir = os.path.join(
+    os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "milatools"
+)
+
+# How long a control master stays alive after its last client disconnects
+control_persist = os.environ.get("MILATOOLS_CONTROL_PERSIST", "10m")
 
 
 T = blessed.Terminal()
 
+# Precedes the header line of each command's results in a batch
+frame_marker = b"@@milatools-frame@@"
+
 
 class Local:
     def display(self, args):
         print(T.bold_green(f"(local) $ ", shlex.join(args)))
 
-    def get(self, *args, **kwargs):
-        self.display(args)
-        return subprocess.check_output(
-            args,
-            universal_newlines=True,
-            **kwargs,
-        )
+    def get(self, *args, quiet=False, **kwargs):
+        if not quiet:
+            self.display(args)
+        with tracer.span("local", "local", args) as event:
+            output = subprocess.check_output(
+                args,
+                universal_newlines=True,
+                **kwargs,
+            )
+            event["bytes"] = len(output)
+            return output
 
     def run(self, *args, **kwargs):
         self.display(args)
-        return subprocess.run(
-            args,
-            universal_newlines=True,
-            **kwargs,
-        )
+        with tracer.span("local", "local", args) as event:
+            results = subprocess.run(
+                args,
+                universal_newlines=True,
+                **kwargs,
+            )
+            event["returncode"] = results.returncode
+            event["bytes"] = len(results.stdout or "")
+            return results
 
-    def popen(self, *args, **kwargs):
+    def popen(self, *args, phase="local", **kwargs):
         self.display(args)
-        return subprocess.Popen(
+        proc = subprocess.Popen(
             args,
             universal_newlines=True,
             **kwargs,
         )
+        tracer.watch(proc, phase, "local", args)
+        return proc
 
     def check_passwordless(self, host):
         results = self.run(
@@ -62,21 +95,65 @@ class Local:
 
 
 class SSHConnection:
-    def __init__(self, host):
+    """Run commands on a host through a shared control master.
+
+    With shell=True, get and get_many are sent to a persistent RemoteShell
+    instead of starting a new ssh process each time, falling back to one
+    process per command if the shell dies. extract always uses its own
+    process, since it streams the output of long-running commands.
+    """
+
+    def __init__(self, host, persist=None, shell=False):
         self.here = Local()
         os.makedirs(sockdir, mode=0o700, exist_ok=True)
         self.host = host
         self.sock = os.path.join(sockdir, f"milatools.{host}")
-        self.master = self.here.popen(
-            "ssh",
-            host,
-            "-fNMS",
-            self.sock,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-        )
+        self.persist = persist or control_persist
+        self.shell = None
+        self.use_shell = shell
+        self.procs = []
+        self.last_used = time.monotonic()
+        if self.check():
+            # Attach to the master started by a previous command
+            self.master = None
+        else:
+            if os.path.exists(self.sock):
+                # The master that created this socket is dead
+                os.remove(self.sock)
+            self.master = self.here.popen(
+                "ssh",
+                host,
+                "-fNMS",
+                self.sock,
+                f"-oControlPersist={self.persist}",
+                phase="auth",
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+            )
+
+    def check(self):
+        """Check whether a live master is listening on the control socket."""
+        if not os.path.exists(self.sock):
+            return False
+        with tracer.span("master", self.host, ["-O", "check"]) as event:
+            results = subprocess.run(
+                ["ssh", "-S", self.sock, "-O", "check", self.host],
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+            event["returncode"] = results.returncode
+        return results.returncode == 0
+
+    @property
+    def busy(self):
+        """Whether a process started with popen is still running."""
+        self.procs = [proc for proc in self.procs if _running(proc)]
+        return bool(self.procs)
 
     def cmd(self, *args, bash=False):
+        # Without a socket to attach to, the command would log in on its own
+        self.wait()
+        self.last_used = time.monotonic()
         if bash:
             args = [shlex.join(["bash", "-c", *args])]
         return ["ssh", self.host, "-S", self.sock, *args]
@@ -84,45 +161,539 @@ class SSHConnection:
     def display(self, args):
         print(T.bold_cyan(f"({self.host}) $ ", *args))
 
-    def get(self, *args, bash=False):
-        self.display(args)
+    def get(self, *args, bash=False, quiet=False):
+        if self.use_shell:
+            command = shlex.join(["bash", "-c", *args]) if bash else " ".join(args)
+            (result,) = self.get_many([command], quiet=quiet)
+            sys.stderr.write(result.stderr)
+            result.check_returncode()
+            return result.stdout
+        if not quiet:
+            self.display(args)
         cmd = self.cmd(*args, bash=bash)
-        return subprocess.check_output(
-            cmd,
-            universal_newlines=True,
+        with tracer.span("remote", self.host, args) as event:
+            output = subprocess.check_output(
+                cmd,
+                universal_newlines=True,
+            )
+            event["bytes"] = len(output)
+            return output
+
+    def get_many(self, commands, quiet=False):
+        """Run several commands in a single round trip.
+
+        The commands are run one after the other by the same remote bash
+        process. Returns a CompletedProcess (stdout, stderr, returncode) for
+        each command. With quiet=True, the commands are not printed.
+        """
+        if not commands:
+            return []
+        for command in commands:
+            if not quiet:
+                self.display([command])
+        with tracer.span("remote", self.host, ["; ".join(commands)]) as event:
+            results = self._get_many(commands)
+            event["bytes"] = sum(len(r.stdout) + len(r.stderr) for r in results)
+            event["returncode"] = max(r.returncode for r in results)
+            return results
+
+    def _get_many(self, commands):
+        if self.use_shell:
+            try:
+                if self.shell is None:
+                    self.shell = RemoteShell(self)
+                return self.shell.run_many(commands)
+            except OSError:
+                # The batch was not sent, so it can safely run again
+                print(T.bold_red("# Remote shell died, using one ssh per command"))
+                self.shell = None
+                self.use_shell = False
+            except EOFError:
+                # Some commands may have run, running them again could repeat
+                # their effects (e.g. submit the same jobs twice)
+                self.shell = None
+                self.use_shell = False
+                raise
+            except BaseException:
+                # run_many killed the shell, whose unread frames are lost
+                self.shell = None
+                raise
+        script = "\n".join(
+            [
+                _frame_setup,
+                *(_frame(i, command) for i, command in enumerate(commands)),
+            ]
         )
+        output = io.BytesIO(subprocess.check_output(self.cmd(script, bash=True)))
+        return [_read_frame(output, command, i) for i, command in enumerate(commands)]
 
-    def popen(self, *args, bash=False):
-        self.display(args)
+    def put(self, data, path):
+        """Write data (str or bytes) to a remote file, through stdin."""
+        if isinstance(data, str):
+            data = data.encode()
+        path = shlex.quote(path)
+        command = f"mkdir -p $(dirname {path}) && cat > {path}"
+        self.display([command])
+        with tracer.span("remote", self.host, [command]) as event:
+            subprocess.run(self.cmd(command), input=data, check=True)
+            event["bytes"] = len(data)
+
+    def pipe(self, stdin, *args, bash=False, quiet=False):
+        """Run a command with a local file object as its stdin."""
+        if not quiet:
+            self.display(args)
+        with tracer.span("remote", self.host, args) as event:
+            results = subprocess.run(self.cmd(*args, bash=bash), stdin=stdin)
+            event["returncode"] = results.returncode
+        results.check_returncode()
+
+    def popen(self, *args, bash=False, quiet=False, **kwargs):
+        if not quiet:
+            self.display(args)
         cmd = self.cmd(*args, bash=bash)
-        return subprocess.Popen(
+        proc = subprocess.Popen(
             cmd,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            universal_newlines=True,
+            **{
+                "stdout": subprocess.PIPE,
+                "stderr": subprocess.STDOUT,
+                "universal_newlines": True,
+                **kwargs,
+            },
         )
+        self.procs.append(proc)
+        tracer.watch(proc, "remote", self.host, args)
+        return proc
+
+    def extract(
+        self, *args, pattern=None, patterns={}, timeout=None, wait=False, bash=False
+    ):
+        """Run a command and watch its stdout and stderr for patterns.
+
+        patterns maps regular expressions to callbacks, which are called with
+        the match object of every line that matches. The first callback that
+        returns something other than None ends the extraction, unless wait is
+        True. pattern is a shortcut for a pattern that returns its first group.
 
-    def extract(self, *args, pattern, wait=False, bash=False):
-        proc = self.popen(*args, bash=bash)
+        Returns (proc, result) if the process is still running, otherwise
+        (None, result). Raises subprocess.TimeoutExpired if no callback
+        returned a result within timeout seconds.
+        """
+        table = _pattern_table(pattern, patterns)
+        proc = self.popen(
+            *args, bash=bash, stderr=subprocess.PIPE, universal_newlines=False
+        )
+        deadline = None if timeout is None else time.monotonic() + timeout
         result = None
         try:
-            while line := proc.stdout.readline():
-                print("#", line.rstrip())
-                if m := re.match(pattern, line):
-                    result = m.groups()[0]
-                    if not wait:
-                        return proc, result
+            with tracer.span("wait", self.host, args) as event:
+                for line in _watch_lines(proc, deadline, timeout):
+                    event["bytes"] += len(line)
+                    if (value := _match_line(table, line)) is not None:
+                        result = value
+                        if not wait:
+                            return proc, result
         except KeyboardInterrupt:
             proc.terminate()
             exit("Canceled")
+        except BaseException:
+            proc.terminate()
+            raise
         proc.wait()
         return None, result
 
+    def forward(self, port, host="localhost", local_port=None):
+        """Forward a local port to host:port, as seen from this host.
+
+        The forward is added to the running master, so it does not open a
+        new connection. A free local port is picked if local_port is None,
+        preferably port itself. Returns the local port.
+        """
+        if local_port is None:
+            local_port = free_port(port)
+        # A new master must be done authenticating
+        self.wait()
+        self._forward("forward", f"{local_port}:{host}:{port}")
+        return local_port
+
+    def cancel(self, local_port, port, host="localhost"):
+        """Remove a forward added with forward()."""
+        self._forward("cancel", f"{local_port}:{host}:{port}")
+
+    def _forward(self, operation, spec):
+        args = ["-O", operation, "-L", spec]
+        with tracer.span("master", self.host, args) as event:
+            results = subprocess.run(
+                ["ssh", "-S", self.sock, *args, self.host],
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.PIPE,
+                universal_newlines=True,
+            )
+            event["returncode"] = results.returncode
+        if results.returncode != 0:
+            raise subprocess.CalledProcessError(
+                results.returncode, results.args, stderr=results.stderr
+            )
+
     def wait(self):
-        self.master.wait()
+        """Wait until a master started by this object is done authenticating.
+
+        ssh -f goes to the background once authenticated, so this returns
+        as soon as the control socket can be used.
+        """
+        if self.master is not None and self.master.returncode is None:
+            self.master.wait()
+
+    def close(self):
+        """Release this object's resources, leaving the master running."""
+        if self.shell is not None:
+            self.shell.close()
+            self.shell = None
 
     def cleanup(self):
-        pass
+        """Close the connection and shut down its control master."""
+        self.close()
+        subprocess.run(
+            ["ssh", "-S", self.sock, "-O", "exit", self.host],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        if os.path.exists(self.sock):
+            os.remove(self.sock)
+
+
+def _pattern_table(pattern, patterns):
+    table = [(re.compile(p), callback) for p, callback in patterns.items()]
+    if pattern is not None:
+        table.insert(0, (re.compile(pattern), lambda m: m.groups()[0]))
+    return table
+
+
+def _match_line(table, line):
+    print("#", line.rstrip())
+    for regex, callback in table:
+        if (m := regex.match(line)) and (value := callback(m)) is not None:
+            return value
+    return None
+
+
+def _watch_lines(proc, deadline, timeout):
+    """Yield the lines of proc's stdout and stderr as soon as they come in."""
+    sel = selectors.DefaultSelector()
+    try:
+        buffers = {}
+        for stream in (proc.stdout, proc.stderr):
+            sel.register(stream, selectors.EVENT_READ)
+            buffers[stream.fileno()] = b""
+        while sel.get_map():
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                raise subprocess.TimeoutExpired(proc.args, timeout)
+            for key, _ in sel.select(remaining):
+                chunk = os.read(key.fd, 65536)
+                if not chunk:
+                    sel.unregister(key.fileobj)
+                    lines = [buffers.pop(key.fd)] if buffers[key.fd] else []
+                else:
+                    *lines, buffers[key.fd] = (buffers[key.fd] + chunk).split(b"\n")
+                for line in lines:
+                    yield line.decode(errors="replace") + "\n"
+    finally:
+        sel.close()
+
+
+def free_port(preferred=0):
+    """A local port that nothing listens on, preferably the given one."""
+    for port in (preferred, 0):
+        with socket.socket() as sock:
+            try:
+                sock.bind(("127.0.0.1", port))
+            except OSError:
+                continue
+            return sock.getsockname()[1]
+
+
+def _running(proc):
+    if isinstance(proc, subprocess.Popen):
+        proc.poll()
+    return proc.returncode is None
+
+
+class SSHConnectionPool:
+    """Process-wide registry handing out one shared SSHConnection per host.
+
+    Masters that were not used for idle_ttl seconds are shut down, and at
+    most max_masters are kept at once: the least recently used one is shut
+    down to make room for a new host. Keyword arguments to get only apply
+    when the connection is created.
+    """
+
+    def __init__(self, idle_ttl=600, max_masters=4):
+        self.idle_ttl = idle_ttl
+        self.max_masters = max_masters
+        self.connections = {}
+        self.lock = threading.Lock()
+
+    def get(self, host, cls=SSHConnection, **kwargs):
+        with self.lock:
+            self.evict_idle()
+            if host not in self.connections:
+                idle = [c for c in self.connections.values() if not c.busy]
+                while idle and len(self.connections) >= self.max_masters:
+                    self.evict(min(idle, key=lambda c: c.last_used).host)
+                    idle = [c for c in self.connections.values() if not c.busy]
+                self.connections[host] = cls(host, **kwargs)
+            conn = self.connections[host]
+            conn.last_used = time.monotonic()
+            return conn
+
+    def evict(self, host):
+        self.connections.pop(host).cleanup()
+
+    def evict_idle(self):
+        now = time.monotonic()
+        for conn in list(self.connections.values()):
+            if not conn.busy and now - conn.last_used > self.idle_ttl:
+                self.evict(conn.host)
+
+    def close(self):
+        """Release all connections, leaving their masters to ControlPersist."""
+        for conn in self.connections.values():
+            conn.close()
+        self.connections.clear()
+
+    def shutdown(self):
+        """Shut down all connections and their masters."""
+        for host in list(self.connections):
+            self.evict(host)
+
+
+connections = SSHConnectionPool()
+atexit.register(connections.close)
+
+
+_frame_setup = "tmp=$(mktemp -d); trap 'rm -rf \"$tmp\"' EXIT"
+
+
+def _frame(index, command):
+    """Shell code that runs command and prints its framed results.
+
+    The results are a header line with the command's index, exit code and
+    the byte counts of its stdout and stderr, followed by both outputs.
+    """
+    marker = frame_marker.decode()
+    return (
+        f'bash -c {shlex.quote(command)} >"$tmp/out" 2>"$tmp/err" </dev/null; '
+        f'rc=$?; printf "\\n{marker} {index} $rc %d %d\\n" '
+        '$(wc -c <"$tmp/out") $(wc -c <"$tmp/err"); cat "$tmp/out" "$tmp/err"'
+    )
+
+
+def _read_frame(stream, command, index):
+    # Anything printed outside of a frame (e.g. by .bashrc) is skipped
+    while not (line := stream.readline()).startswith(frame_marker):
+        if not line:
+            raise EOFError(f"Connection closed while running: {command}")
+    _, frame, rc, nout, nerr = line.split()
+    if int(frame) != index:
+        raise RuntimeError(f"Expected frame {index}, got {int(frame)}: {command}")
+    return subprocess.CompletedProcess(
+        args=command,
+        returncode=int(rc),
+        stdout=stream.read(int(nout)).decode(errors="replace"),
+        stderr=stream.read(int(nerr)).decode(errors="replace"),
+    )
+
+
+class RemoteShell:
+    """Long-lived remote bash process that runs framed commands.
+
+    The shell is started once over the control master, so each command only
+    costs a write on an open channel instead of a new ssh process and login.
+    """
+
+    def __init__(self, connection):
+        self.proc = subprocess.Popen(
+            connection.cmd("bash"),
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+        )
+        self.ids = itertools.count()
+        self.lock = threading.Lock()
+        self.send(_frame_setup)
+
+    def send(self, code):
+        self.proc.stdin.write(code.encode() + b"\n")
+        self.proc.stdin.flush()
+
+    def run(self, command):
+        (result,) = self.run_many([command])
+        return result
+
+    def run_many(self, commands):
+        """Run the commands, in order.
+
+        Raises OSError if the shell was dead before anything was sent, and
+        EOFError if it died while the commands ran. The shell is killed if
+        anything goes wrong while reading the results, since it would give
+        the rest of them to the next batch.
+        """
+        with self.lock:
+            if self.proc.poll() is not None:
+                raise OSError(f"Remote shell exited with code {self.proc.returncode}")
+            ids = [next(self.ids) for _ in commands]
+            self.send("\n".join(_frame(i, c) for i, c in zip(ids, commands)))
+            try:
+                return [
+                    _read_frame(self.proc.stdout, command, i)
+                    for i, command in zip(ids, commands)
+                ]
+            except BaseException:
+                self.proc.kill()
+                self.proc.wait()
+                raise
+
+    def close(self):
+        try:
+            self.proc.stdin.close()
+            self.proc.wait(timeout=5)
+        except (OSError, subprocess.TimeoutExpired):
+            self.proc.kill()
+            self.proc.wait()
+
+
+class AsyncSSHConnection:
+    """Coroutine versions of the commands of an SSHConnection.
+
+    Every command is a new channel on the connection's control master, so
+    independent queries can run concurrently with ``asyncio.gather``. With
+    the shell backend, get and get_many go through the remote shell, one
+    batch at a time, from a worker thread (a timeout does not stop a command
+    that was sent to the shell). Timeouts raise subprocess.TimeoutExpired,
+    like SSHConnection.extract.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.host = connection.host
+        # Tasks that record the lifetime of processes in the trace
+        self.traces = set()
+
+    async def cmd(self, *args, bash=False):
+        # A new master may still be authenticating (e.g. waiting for 2FA),
+        # which SSHConnection.cmd waits for: do it without blocking the loop
+        await asyncio.get_event_loop().run_in_executor(None, self.connection.wait)
+        return self.connection.cmd(*args, bash=bash)
+
+    async def get(self, *args, bash=False, quiet=False, timeout=None):
+        if self.connection.use_shell:
+            get = functools.partial(self.connection.get, *args, bash=bash, quiet=quiet)
+            return await _in_thread(get, timeout, args)
+        if not quiet:
+            self.connection.display(args)
+        cmd = await self.cmd(*args, bash=bash)
+        with tracer.span("remote", self.host, args) as event:
+            proc = await asyncio.create_subprocess_exec(*cmd, stdout=subprocess.PIPE)
+            try:
+                stdout, _ = await _wait_for(proc.communicate(), timeout, args)
+            finally:
+                await _reap(proc)
+            event["bytes"] = len(stdout)
+            if proc.returncode != 0:
+                raise subprocess.CalledProcessError(proc.returncode, cmd, output=stdout)
+            return stdout.decode()
+
+    async def get_many(self, commands, quiet=False, timeout=None):
+        get_many = functools.partial(self.connection.get_many, commands, quiet=quiet)
+        return await _in_thread(get_many, timeout, commands)
+
+    async def popen(self, *args, bash=False, quiet=False):
+        if not quiet:
+            self.connection.display(args)
+        cmd = await self.cmd(*args, bash=bash)
+        proc = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+        )
+        self.connection.procs.append(proc)
+        if tracer.enabled:
+            task = asyncio.ensure_future(_trace(proc, self.host, args))
+            self.traces.add(task)
+            task.add_done_callback(self.traces.discard)
+        return proc
+
+    async def extract(
+        self, *args, pattern=None, patterns={}, timeout=None, wait=False, bash=False
+    ):
+        """Coroutine version of SSHConnection.extract."""
+        table = _pattern_table(pattern, patterns)
+        proc = await self.popen(*args, bash=bash)
+        try:
+            with tracer.span("wait", self.host, args):
+                result = await _wait_for(_scan(proc, table, wait), timeout, args)
+            if result is not None and not wait:
+                return proc, result
+        except BaseException:
+            await _reap(proc)
+            raise
+        await proc.wait()
+        return None, result
+
+
+async def _in_thread(fn, timeout, args):
+    future = asyncio.get_event_loop().run_in_executor(None, fn)
+    return await _wait_for(future, timeout, args)
+
+
+async def _wait_for(awaitable, timeout, args):
+    try:
+        return await asyncio.wait_for(awaitable, timeout)
+    except asyncio.TimeoutError:
+        raise subprocess.TimeoutExpired(list(args), timeout) from None
+
+
+async def _trace(proc, host, args):
+    with tracer.span("remote", host, args) as event:
+        event["returncode"] = await proc.wait()
+
+
+async def _scan(proc, table, wait):
+    result = None
+    while line := (await proc.stdout.readline()).decode():
+        if (value := _match_line(table, line)) is not None:
+            result = value
+            if not wait:
+                break
+    return result
+
+
+async def _reap(proc):
+    """Kill proc if it is still running (e.g. after a timeout or cancellation)."""
+    if proc.returncode is None:
+        proc.kill()
+        await proc.wait()
+
+
+def read_json(path, default=None):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return default
+
+
+def write_json(path, data):
+    """Write data to path atomically, so concurrent readers never see half a file."""
+    dirname = os.path.dirname(path)
+    os.makedirs(dirname, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=dirname, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(data, f, indent=2)
+        os.replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
 
 
 def yn(question, default="y"):
@@ -0,0 +1,198 @@
+import asyncio
+import io
+import os
+import subprocess
+import time
+
+import pytest
+
+from milatools import utils
+from milatools.trace import tracer
+from milatools.utils import (
+    AsyncSSHConnection,
+    SSHConnection,
+    _frame,
+    _frame_setup,
+    _read_frame,
+)
+
+
+class LocalConnection(SSHConnection):
+    """SSHConnection that runs its commands with a local bash."""
+
+    def __init__(self, shell=True):
+        self.host = "local"
+        self.master = None
+        self.shell = None
+        self.use_shell = shell
+        self.procs = []
+
+    def cmd(self, *args, bash=False):
+        return ["bash"] if args == ("bash",) else ["bash", "-c", *args]
+
+
+def frames(*commands):
+    script = "\n".join([_frame_setup, *(_frame(i, c) for i, c in enumerate(commands))])
+    return io.BytesIO(subprocess.check_output(["bash", "-c", script]))
+
+
+def test_read_frame():
+    stream = frames("echo out; echo err >&2; exit 3", "printf 'no newline'")
+    first = _read_frame(stream, "first", 0)
+    assert (first.stdout, first.stderr, first.returncode) == ("out\n", "err\n", 3)
+    second = _read_frame(stream, "second", 1)
+    assert (second.stdout, second.returncode) == ("no newline", 0)
+
+
+def test_read_frame_not_utf8():
+    result = _read_frame(frames("printf '\\xff'"), "printf", 0)
+    assert result.stdout == "�"
+
+
+def test_read_frame_skips_noise():
+    script = f"echo from bashrc; {_frame_setup}; {_frame(0, 'echo hi')}"
+    stream = io.BytesIO(subprocess.check_output(["bash", "-c", script]))
+    assert _read_frame(stream, "echo hi", 0).stdout == "hi\n"
+
+
+def test_read_frame_out_of_step():
+    stream = frames("echo first", "echo second")
+    with pytest.raises(RuntimeError):
+        _read_frame(stream, "echo second", 1)
+
+
+def test_read_frame_closed():
+    with pytest.raises(EOFError):
+        _read_frame(io.BytesIO(b"partial output"), "command", 0)
+
+
+@pytest.mark.parametrize("shell", [True, False])
+def test_get_many(shell):
+    conn = LocalConnection(shell=shell)
+    results = conn.get_many(["printf '\\xff'", "echo second", "false"], quiet=True)
+    assert [r.stdout for r in results] == ["�", "second\n", ""]
+    assert [r.returncode for r in results] == [0, 0, 1]
+    assert conn.get_many([]) == []
+
+
+def test_shell_interrupted_mid_batch(monkeypatch):
+    conn = LocalConnection()
+    read_frame = utils._read_frame
+
+    def interrupted(stream, command, index):
+        if command == "echo second":
+            raise KeyboardInterrupt()
+        return read_frame(stream, command, index)
+
+    monkeypatch.setattr(utils, "_read_frame", interrupted)
+    with pytest.raises(KeyboardInterrupt):
+        conn.get_many(["echo first", "echo second"], quiet=True)
+    assert conn.shell is None
+    monkeypatch.setattr(utils, "_read_frame", read_frame)
+    # A new shell is started, rather than reading the frame left behind
+    (result,) = conn.get_many(["echo third"], quiet=True)
+    assert result.stdout == "third\n"
+    assert conn.use_shell
+
+
+def test_get_bash_script():
+    for shell in (True, False):
+        conn = LocalConnection(shell=shell)
+        output = conn.get("echo $((1+2)); echo <(true)", bash=True, quiet=True)
+        assert output.startswith("3\n/dev/fd/")
+
+
+@pytest.mark.parametrize("shell", [True, False])
+def test_async_get(shell):
+    conn = AsyncSSHConnection(LocalConnection(shell=shell))
+
+    async def main():
+        return await asyncio.gather(
+            conn.get("echo one", quiet=True),
+            conn.get("echo $((1+2))", bash=True, quiet=True),
+            conn.get_many(["echo a", "false"], quiet=True),
+        )
+
+    one, three, many = asyncio.run(main())
+    assert (one, three) == ("one\n", "3\n")
+    assert [r.returncode for r in many] == [0, 1]
+
+
+def test_async_concurrent():
+    conn = AsyncSSHConnection(LocalConnection(shell=False))
+
+    async def main():
+        await asyncio.gather(*(conn.get("sleep 0.3", quiet=True) for _ in range(3)))
+
+    start = time.monotonic()
+    asyncio.run(main())
+    assert time.monotonic() - start < 0.8
+
+
+def test_async_waits_for_master_without_blocking():
+    local = LocalConnection(shell=False)
+    # A master still authenticating
+    local.master = subprocess.Popen(["sleep", "0.3"])
+    conn = AsyncSSHConnection(local)
+    ticks = []
+
+    async def tick():
+        while local.master.poll() is None:
+            ticks.append(None)
+            await asyncio.sleep(0.01)
+
+    async def main():
+        output, _ = await asyncio.gather(conn.get("echo ok", quiet=True), tick())
+        return output
+
+    assert asyncio.run(main()) == "ok\n"
+    assert len(ticks) > 5
+
+
+def test_async_timeout():
+    conn = AsyncSSHConnection(LocalConnection(shell=False))
+    with pytest.raises(subprocess.TimeoutExpired):
+        asyncio.run(conn.get("sleep 5", quiet=True, timeout=0.1))
+
+
+def test_async_extract(monkeypatch):
+    monkeypatch.setattr(tracer, "enabled", True)
+    monkeypatch.setattr(tracer, "events", [])
+    conn = AsyncSSHConnection(LocalConnection(shell=False))
+
+    async def main():
+        proc, port = await conn.extract(
+            "echo starting; echo port 1234; sleep 0.1", pattern="port ([0-9]+)"
+        )
+        await proc.wait()
+        # Let the trace task see the process end
+        await asyncio.sleep(0.05)
+        return port
+
+    assert asyncio.run(main()) == "1234"
+    assert not conn.traces
+    remote = [e for e in tracer.events if e["phase"] == "remote"]
+    assert [e["returncode"] for e in remote] == [0]
+
+
+def test_extract_closes_selector():
+    conn = LocalConnection(shell=False)
+
+    def selectors():
+        # Each selector holds an epoll file descriptor
+        count = 0
+        for fd in os.listdir("/proc/self/fd"):
+            try:
+                count += os.readlink(f"/proc/self/fd/{fd}") == "anon_inode:[eventpoll]"
+            except FileNotFoundError:
+                pass
+        return count
+
+    before = selectors()
+    proc, port = conn.extract("echo port 1234; sleep 5", pattern="port ([0-9]+)")
+    assert port == "1234"
+    proc.terminate()
+    proc.wait()
+    with pytest.raises(subprocess.TimeoutExpired):
+        conn.extract("sleep 5", pattern="port ([0-9]+)", timeout=0.1)
+    assert selectors() == before
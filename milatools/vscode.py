@@ -0,0 +1,130 @@
+import os
+import re
+import shlex
+import subprocess
+import tempfile
+import urllib.request
+
+from .utils import T, cachedir
+
+# Server tarballs downloaded once on this machine, to push to the cluster
+tarballs_dir = os.path.join(cachedir, "vscode-server")
+
+download_url = (
+    "https://update.code.visualstudio.com/commit:{commit}/server-linux-{arch}/stable"
+)
+
+# uname -m -> VSCode's name for the architecture
+archs = {"x86_64": "x64", "aarch64": "arm64", "armv7l": "armhf"}
+
+# Where the Remote-SSH extension looks for the server of each commit, relative
+# to ~/.vscode-server: in cli/servers/ with its exec server (the default in
+# current versions), in bin/ without it
+server_dirs = ["bin/{commit}", "cli/servers/Stable-{commit}"]
+exec_server_dir = "cli/servers/Stable-{commit}/server"
+legacy_server_dir = "bin/{commit}"
+
+# Local VSCode settings, on Linux, macOS and Windows
+settings_paths = [
+    os.path.expanduser("~/.config/Code/User/settings.json"),
+    os.path.expanduser("~/Library/Application Support/Code/User/settings.json"),
+    os.path.expandvars("$APPDATA/Code/User/settings.json"),
+]
+
+
+def local_commit(here, quiet=False):
+    """Commit of the local VSCode, which the remote server has to match."""
+    try:
+        lines = here.get("code", "--version", quiet=quiet).splitlines()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return lines[1] if len(lines) > 1 else None
+
+
+def uses_exec_server():
+    """Whether the local Remote-SSH extension uses its exec server.
+
+    It does unless remote.SSH.useExecServer is false in the user settings
+    (which may have comments, so they are not parsed as JSON).
+    """
+    for path in settings_paths:
+        try:
+            with open(path) as f:
+                settings = f.read()
+        except OSError:
+            continue
+        return not re.search(r'"remote\.SSH\.useExecServer"\s*:\s*false', settings)
+    return True
+
+
+def server_dir(commit, exec_server=True):
+    """Where the server for commit is unpacked, relative to ~/.vscode-server."""
+    return (exec_server_dir if exec_server else legacy_server_dir).format(commit=commit)
+
+
+def installed(ssh, commit, exec_server=True, quiet=False):
+    path = server_dir(commit, exec_server)
+    output = ssh.get(
+        f"(cd ~/.vscode-server && ls -d {path}) 2>/dev/null || true", quiet=quiet
+    )
+    return bool(output.strip())
+
+
+def tarball(commit, arch, quiet=False):
+    """Path to the server tarball for commit, downloaded if it is not cached."""
+    path = os.path.join(tarballs_dir, f"vscode-server-linux-{arch}-{commit}.tar.gz")
+    if not os.path.exists(path):
+        os.makedirs(tarballs_dir, exist_ok=True)
+        url = download_url.format(commit=commit, arch=arch)
+        if not quiet:
+            print(T.bold_green(f"# Downloading {url}"))
+        fd, tmp = tempfile.mkstemp(dir=tarballs_dir)
+        try:
+            with os.fdopen(fd, "wb") as f, urllib.request.urlopen(url) as response:
+                while chunk := response.read(1 << 20):
+                    f.write(chunk)
+            os.replace(tmp, path)
+        except BaseException:
+            os.remove(tmp)
+            raise
+    return path
+
+
+def stage(ssh, commit, arch, exec_server=True, quiet=False):
+    """Unpack the server for commit in ~/.vscode-server on the cluster.
+
+    The server goes where the local Remote-SSH extension looks for it (see
+    server_dir). The tarball is streamed through the control socket and
+    unpacked next to its destination, then moved in place, so that a node
+    never sees a partial server.
+    """
+    target = f"~/.vscode-server/{server_dir(commit, exec_server)}"
+    tmp = f"{target}.staging-$$"
+    with open(tarball(commit, arch, quiet), "rb") as f:
+        ssh.pipe(
+            f,
+            f"mkdir -p {tmp} && tar -xzf - -C {tmp} --strip-components=1"
+            f" && mv -T {tmp} {target}"
+            f" || {{ rm -rf {tmp}; exit 1; }}",
+            quiet=quiet,
+        )
+
+
+def builds(ssh):
+    """Server builds on the cluster, newest first (relative to ~/.vscode-server)."""
+    dirs = " ".join(d.format(commit="*") for d in server_dirs)
+    output = ssh.get(f"(cd ~/.vscode-server && ls -dt {dirs}) 2>/dev/null || true")
+    return [line for line in output.splitlines() if ".staging-" not in line]
+
+
+def commit_of(build):
+    return build.rsplit("/", 1)[-1].split("-")[-1]
+
+
+def prune(ssh, builds, keep, current=None):
+    """Remove all builds but the `keep` newest ones and the current commit's."""
+    removed = [b for b in builds[keep:] if commit_of(b) != current]
+    if removed:
+        paths = " ".join(shlex.quote(build) for build in removed)
+        ssh.get(f"cd ~/.vscode-server && rm -rf {paths}")
+    return [b for b in builds if b not in removed]